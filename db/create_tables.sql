@@ -18,7 +18,7 @@ CREATE TABLE pull_request (
     build_started DATE,
     build_failed DATE,
     build_succeeded DATE,
-    s3_arn VARCHAR(80),
+    s3_arn TEXT,
     test_node VARCHAR(60),
     test_started DATE,
     test_succeeded DATE,
@@ -35,5 +35,21 @@ CREATE TABLE pull_request_commit (
     unit_tests_pass boolean default NULL,
     merged boolean NOT NULL default FALSE,
     raised_pr_id INTEGER REFERENCES pull_request(id),
+    paths_indexed boolean NOT NULL default FALSE,
     PRIMARY KEY(pr_id, sha)
 );
+
+CREATE TABLE pull_request_commit_path (
+    pr_id INTEGER NOT NULL,
+    sha VARCHAR(40) NOT NULL,
+    path TEXT NOT NULL,
+    hunk_start INTEGER NOT NULL,
+    hunk_end INTEGER NOT NULL,
+    FOREIGN KEY(pr_id, sha) REFERENCES pull_request_commit(pr_id, sha)
+);
+
+CREATE TABLE import_state (
+    project VARCHAR(24) NOT NULL,
+    last_updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY(project)
+);
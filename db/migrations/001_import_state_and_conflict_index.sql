@@ -0,0 +1,18 @@
+-- Bring databases created before migrations existed up to date with
+-- db/create_tables.sql. Safe to run against a freshly created database.
+CREATE TABLE IF NOT EXISTS import_state (
+    project VARCHAR(24) NOT NULL,
+    last_updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY(project)
+);
+
+ALTER TABLE pull_request_commit ADD COLUMN IF NOT EXISTS paths_indexed boolean NOT NULL default FALSE;
+
+CREATE TABLE IF NOT EXISTS pull_request_commit_path (
+    pr_id INTEGER NOT NULL,
+    sha VARCHAR(40) NOT NULL,
+    path TEXT NOT NULL,
+    hunk_start INTEGER NOT NULL,
+    hunk_end INTEGER NOT NULL,
+    FOREIGN KEY(pr_id, sha) REFERENCES pull_request_commit(pr_id, sha)
+);
@@ -0,0 +1,32 @@
+-- Indexes for the queries run on every coordinator poll and merge pass.
+-- Partial index predicates are written as the queries write them, so the
+-- planner can prove they apply.
+
+-- Coordinator get_prs(): non-closed pull requests for a project, by ID
+CREATE INDEX IF NOT EXISTS pull_request_not_closed_idx
+    ON pull_request (project, id)
+    WHERE state != 'closed';
+
+-- Coordinator get_buildable_prs(): open, unassigned and unclaimed pull requests
+CREATE INDEX IF NOT EXISTS pull_request_buildable_idx
+    ON pull_request (project, milestone_title, base_ref, id)
+    WHERE state = 'open' AND assignee_login IS NULL AND build_node IS NULL;
+
+-- get_commit_oids() and the mass_test_pull_requests.py candidate query:
+-- commits still to be merged, in order
+CREATE INDEX IF NOT EXISTS pull_request_commit_pending_idx
+    ON pull_request_commit (pr_id, ordinality)
+    WHERE to_merge = 't' AND merged = 'f';
+
+-- mark_commits_merged.py and mark_commits_to_do.py update commits by SHA
+CREATE INDEX IF NOT EXISTS pull_request_commit_sha_idx
+    ON pull_request_commit (sha);
+
+-- Commits still to be added to the conflict index
+CREATE INDEX IF NOT EXISTS pull_request_commit_unindexed_idx
+    ON pull_request_commit (pr_id)
+    WHERE paths_indexed = 'f';
+
+-- Loading the conflict index for a set of pull requests
+CREATE INDEX IF NOT EXISTS pull_request_commit_path_commit_idx
+    ON pull_request_commit_path (pr_id, sha);
@@ -0,0 +1,19 @@
+-- GitHub mutations (assign, comment, label) recorded by the coordinator in the
+-- same transaction as the state change they belong to, and sent later by
+-- github_outbox_worker.py
+CREATE TABLE IF NOT EXISTS github_outbox (
+    id SERIAL NOT NULL,
+    url VARCHAR(200) NOT NULL,
+    method VARCHAR(10) NOT NULL,
+    request TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMP DEFAULT NULL,
+    last_error TEXT DEFAULT NULL,
+    PRIMARY KEY(id)
+);
+
+CREATE INDEX IF NOT EXISTS github_outbox_pending_idx
+    ON github_outbox (next_attempt_at, id)
+    WHERE completed_at IS NULL;
@@ -0,0 +1,16 @@
+-- Wake coordinators long-polling for work whenever a pull request may have
+-- become buildable. Deliberately coarse; waiting claims re-run the full
+-- buildable query when woken.
+CREATE OR REPLACE FUNCTION notify_build_ready() RETURNS trigger AS $$
+BEGIN
+    IF NEW.state = 'open' AND NEW.build_node IS NULL THEN
+        PERFORM pg_notify('build_ready', NEW.id::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pull_request_build_ready ON pull_request;
+CREATE TRIGGER pull_request_build_ready
+    AFTER INSERT OR UPDATE ON pull_request
+    FOR EACH ROW EXECUTE PROCEDURE notify_build_ready();
@@ -0,0 +1,54 @@
+-- Single-row counter bumped by every statement which actually changes rows
+-- of pull_request, so the coordinator can compute ETags for its list
+-- endpoints without reading the table itself.
+--
+-- Statements matching no rows (such as a claim finding nothing to build) or
+-- rewriting rows with identical values (such as an import of unchanged pull
+-- requests) leave the counter alone, so they neither change the ETags nor
+-- take the lock on the counter row.
+CREATE TABLE IF NOT EXISTS pull_request_change (
+    id INTEGER NOT NULL DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY(id)
+);
+INSERT INTO pull_request_change (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING;
+
+-- For inserts and deletes, "changed" holds the rows inserted or deleted
+CREATE OR REPLACE FUNCTION bump_pull_request_change() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM changed) THEN
+        UPDATE pull_request_change SET version = version + 1 WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bump_pull_request_change_on_update() RETURNS trigger AS $$
+BEGIN
+    IF EXISTS (SELECT 1
+               FROM changed_new new_row
+                   JOIN changed_old old_row ON old_row.id = new_row.id
+               WHERE new_row.* IS DISTINCT FROM old_row.*) THEN
+        UPDATE pull_request_change SET version = version + 1 WHERE id = 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement level, so a batch write of many rows bumps the counter once
+DROP TRIGGER IF EXISTS pull_request_change_bump ON pull_request;
+DROP TRIGGER IF EXISTS pull_request_change_bump_insert ON pull_request;
+DROP TRIGGER IF EXISTS pull_request_change_bump_update ON pull_request;
+DROP TRIGGER IF EXISTS pull_request_change_bump_delete ON pull_request;
+CREATE TRIGGER pull_request_change_bump_insert
+    AFTER INSERT ON pull_request
+    REFERENCING NEW TABLE AS changed
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_pull_request_change();
+CREATE TRIGGER pull_request_change_bump_update
+    AFTER UPDATE ON pull_request
+    REFERENCING OLD TABLE AS changed_old NEW TABLE AS changed_new
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_pull_request_change_on_update();
+CREATE TRIGGER pull_request_change_bump_delete
+    AFTER DELETE ON pull_request
+    REFERENCING OLD TABLE AS changed
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_pull_request_change();
@@ -0,0 +1,18 @@
+-- Tell coordinators which pull request changed, whoever changed it, so they
+-- can drop cached responses for it. Notifications with the same payload
+-- within a transaction are delivered once, so batch imports stay cheap.
+CREATE OR REPLACE FUNCTION notify_pull_request_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('pull_request_changed', OLD.id::text);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('pull_request_changed', NEW.id::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS pull_request_changed_notify ON pull_request;
+CREATE TRIGGER pull_request_changed_notify
+    AFTER INSERT OR UPDATE OR DELETE ON pull_request
+    FOR EACH ROW EXECUTE PROCEDURE notify_pull_request_changed();
@@ -0,0 +1,16 @@
+-- Build claims are leases: a node must heartbeat before its lease expires,
+-- or the coordinator returns the pull request to the build queue.
+--
+-- Leases live in their own table rather than on pull_request, so heartbeats
+-- don't fire pull_request's triggers: bumping the change counter behind the
+-- coordinator's ETags, and notifying coordinators to drop cached responses,
+-- for a value no response includes.
+CREATE TABLE IF NOT EXISTS build_lease (
+    pr_id INTEGER NOT NULL REFERENCES pull_request(id),
+    expires TIMESTAMP NOT NULL,
+    PRIMARY KEY(pr_id)
+);
+
+-- The reaper's search for expired leases
+CREATE INDEX IF NOT EXISTS build_lease_expires_idx
+    ON build_lease (expires);
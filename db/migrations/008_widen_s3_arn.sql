@@ -0,0 +1,3 @@
+-- Build nodes report content-addressed artifact locations
+-- (arn:aws:s3:::<bucket>/<prefix>/sha256/<hash>.gz), longer than 80 characters
+ALTER TABLE pull_request ALTER COLUMN s3_arn TYPE TEXT;
@@ -0,0 +1,10 @@
+-- Pull requests the mass tester found would not merge or build, and the
+-- commit of the base branch they were tested against. They are left out of
+-- later passes only while the base branch is still at that commit; once it
+-- moves, they may merge or build again and are retried.
+CREATE TABLE IF NOT EXISTS pull_request_test_failure (
+    pr_id INTEGER NOT NULL REFERENCES pull_request(id),
+    base_oid VARCHAR(40) NOT NULL,
+    failed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY(pr_id)
+);
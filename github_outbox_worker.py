@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+import robodoge
+import robodoge.outbox
+import sys
+
+# Script to send the GitHub calls queued by the coordinator. Runs until killed.
+
+config = robodoge.load_configuration('config.yml')
+try:
+    merger = robodoge.Robodoge(config)
+except robodoge.ConfigurationError as err:
+    print(err.msg)
+    sys.exit(1)
+outbox_config = config.get('outbox', {})
+
+conn = merger.get_connection()
+try:
+    worker = robodoge.outbox.OutboxWorker(merger, conn,
+        outbox_config.get('batch_size', robodoge.outbox.DEFAULT_BATCH_SIZE),
+        outbox_config.get('max_attempts', robodoge.outbox.DEFAULT_MAX_ATTEMPTS),
+        outbox_config.get('base_delay', robodoge.outbox.DEFAULT_BASE_DELAY),
+        outbox_config.get('max_delay', robodoge.outbox.DEFAULT_MAX_DELAY),
+        outbox_config.get('claim_timeout', robodoge.outbox.DEFAULT_CLAIM_TIMEOUT))
+    worker.run(outbox_config.get('poll_interval', robodoge.outbox.DEFAULT_POLL_INTERVAL))
+finally:
+    conn.close()
@@ -6,9 +6,21 @@ import subprocess
 import sys
 import time
 import robodoge
+import robodoge.conflicts
+import robodoge.scheduler
+import robodoge.worktrees
 
 # Script to mass evaluate remaining pull requests, and raise them against Dogecoin
-# where feasible.
+# where feasible. Pass --daemon to run continuously.
+
+def viable_prs(items, results, grouped):
+    """ Generator over viable PR IDs, given test results for individual PRs or groups of PRs """
+    for (item, result) in zip(items, results):
+        if grouped:
+            for pr_id in result:
+                yield pr_id
+        elif result:
+            yield item
 
 def build_pr_body(pr_titles, pr_ids):
     contents = []
@@ -20,7 +32,7 @@ def mark_commits_merged(conn, merger, new_pr, pr_ids):
     cursor = conn.cursor()
     try:
         # Mark the new PR to the database
-        robodoge.write_pr(cursor, new_pr, 'dogecoin/dogecoin')
+        robodoge.write_prs(cursor, [new_pr], 'dogecoin/dogecoin')
 
         # Mark component PRs done
         for pr_id in pr_ids:
@@ -40,8 +52,7 @@ def raise_pull_request(conn, merger, pr_titles, pr_ids):
     # Create new branch
     branch_name = 'bitcoin-batch-%d' % int(time.time())
     batch_branch = merger.create_branch(branch_name)
-    repo.checkout(batch_branch)
-    merger.apply_pull_requests(conn, batch_branch, pr_ids)
+    merger.apply_pull_requests_to_branch(conn, batch_branch, pr_ids, False)
 
     # Push branch upstream and raise PR
     branch_ref = repo.lookup_reference('refs/heads/' + batch_branch.branch_name)
@@ -55,82 +66,140 @@ def raise_pull_request(conn, merger, pr_titles, pr_ids):
     new_pr = merger.raise_pr('dogecoin/dogecoin', title, body, batch_branch.branch_name)
     mark_commits_merged(conn, merger, new_pr, pr_ids)
 
-def test_pr_merge(conn, merger, pr_id):
+def base_commit_oid(merger):
+    """ Hex ID of the commit the base branch is currently at, which PRs are tested against """
+    base_branch_ref = merger.repo.lookup_reference('refs/remotes/' + merger.base_branch.branch_name)
+    return str(base_branch_ref.peel(pygit2.Commit).id)
+
+def record_failed_prs(conn, pr_ids, base_oid):
     """
-    Test if a pull request can be cleanly merged against the current development branch. Returns true/false
+    Record that the given pull requests failed to merge or build against the
+    base branch at "base_oid", so they're left out of later passes until the
+    base branch moves
     """
-
-    path = merger.config['dogecoin_repo']['path']
-    repo = merger.repo
-
-    # Test if the branch exists already, create it if not
-    head_branch = merger.create_branch('bitcoin-pr-%d' % pr_id)
-    if not head_branch:
-        return False
+    cursor = conn.cursor()
     try:
-        repo.checkout(head_branch)
-
-        if not merger.apply_pull_requests(conn, head_branch, [pr_id]):
-            return False
-
-        # Make sure it's a viable build too
-        print('Attempting compilation of PR %d' % pr_id)
-        try:
-            robodoge.compile_dogecoin(path)
-        except robodoge.BuildError:
-            return False
+        for pr_id in pr_ids:
+            cursor.execute("""INSERT INTO pull_request_test_failure (pr_id, base_oid)
+                              VALUES (%(pr_id)s, %(base_oid)s)
+                              ON CONFLICT (pr_id) DO UPDATE
+                              SET base_oid=EXCLUDED.base_oid, failed_at=NOW()""",
+                           {'pr_id': pr_id, 'base_oid': base_oid})
+        conn.commit()
     finally:
-        repo.checkout(merger.safe_branch)
-        repo.lookup_branch(head_branch.branch_name, pygit2.GIT_BRANCH_LOCAL).delete()
-
-    return True
-
-config = robodoge.load_configuration('config.yml')
-try:
-    merger = robodoge.Robodoge(config)
-except robodoge.ConfigurationError as err:
-    print(err.msg)
-    sys.exit(1)
+        cursor.close()
 
-conn = merger.get_connection()
-try:
+def find_pending_prs(conn, base_oid):
+    """
+    Find pull requests with commits still to merge, returning their IDs in
+    merge order and their titles. Pull requests which already failed against
+    the base branch at "base_oid" are skipped; those which failed against an
+    earlier base are tried again.
+    """
     pr_titles = {}
     ordered_pr_ids = []
     cursor = conn.cursor()
     try:
-        # Find pull requests to evaluate
         cursor.execute(
             """SELECT pr.id, pr.title
                 FROM pull_request pr
                     JOIN pull_request_commit commit ON commit.pr_id=pr.id
+                    LEFT JOIN pull_request_test_failure failure ON failure.pr_id=pr.id
                 WHERE commit.to_merge='t' AND commit.merged='f'
-                ORDER BY pr.merged_at, pr.id ASC""")
+                    AND (failure.base_oid IS NULL OR failure.base_oid<>%(base_oid)s)
+                ORDER BY pr.merged_at, pr.id ASC""", {'base_oid': base_oid})
         for record in cursor:
             pr_id = record[0]
-            if pr_id not in ordered_pr_ids:
+            if pr_id not in pr_titles:
                 ordered_pr_ids.append(pr_id)
                 pr_titles[pr_id] = record[1]
     finally:
         cursor.close()
+    return (ordered_pr_ids, pr_titles)
+
+def evaluate_prs(conn, merger, config, ordered_pr_ids, conflict_index):
+    """ Test which pull requests can be merged and built, returning the viable ones in order """
+    # With a group size above 1, PRs are built a group at a time, only
+    # bisecting groups which fail. Otherwise each PR is built individually.
+    group_size = config.get('mass_test', {}).get('group_size', 1)
+    if group_size > 1:
+        items = robodoge.conflicts.plan_batches(ordered_pr_ids, conflict_index, group_size)
+        test = robodoge.group_test_pr_merges
+    else:
+        items = ordered_pr_ids
+        test = robodoge.test_pr_merge
+
+    worktrees_config = config['dogecoin_repo'].get('worktrees')
+    if worktrees_config:
+        # Evaluate in parallel, one per linked worktree, with results
+        # returned in the original order so batching stays deterministic
+        pool = robodoge.worktrees.WorktreePool(merger, worktrees_config['path'], worktrees_config.get('count', os.cpu_count()))
+        pool.create()
+        results = pool.imap(test, items)
+    else:
+        results = (test(conn, merger, item) for item in items)
+
+    return list(viable_prs(items, results, group_size > 1))
+
+def run_pass(conn, merger, config, scheduler):
+    """
+    Evaluate all pending pull requests and raise the viable ones in batches,
+    as the scheduler allows. Returns the number of batches raised.
+    """
+    base_oid = base_commit_oid(merger)
+    (ordered_pr_ids, pr_titles) = find_pending_prs(conn, base_oid)
+    if not ordered_pr_ids:
+        return 0
+
+    # Index the files each PR touches, so PRs can be grouped without overlaps
+    robodoge.conflicts.update_conflict_index(conn, merger.repo)
+    conflict_index = robodoge.conflicts.load_conflict_index(conn, ordered_pr_ids)
 
-    viable_pr_ids = []
-    for pr_id in ordered_pr_ids:
-        if test_pr_merge(conn, merger, pr_id):
-            viable_pr_ids.append(pr_id)
-        if len(viable_pr_ids) == 4:
-            try:
-                raise_pull_request(conn, merger, pr_titles, viable_pr_ids)
-            except robodoge.BranchCollisionError as err:
-                print(err.msg)
-            viable_pr_ids = []
-            time.sleep(60*60) # Give the server a break
-
-    if len(viable_pr_ids) > 0:
+    try:
+        remaining = evaluate_prs(conn, merger, config, ordered_pr_ids, conflict_index)
+    except robodoge.BuildSetupError as err:
+        # A problem with the build environment rather than the PRs; record
+        # nothing, and try them all again next pass
+        print('Could not set up builds, abandoning this pass: %s' % err.cause)
+        return 0
+    failed = [pr_id for pr_id in ordered_pr_ids if pr_id not in remaining]
+    if failed:
+        print('%d pull requests failed to merge or build, skipping them until %s moves' % (len(failed), merger.base_branch.branch_name))
+        record_failed_prs(conn, failed, base_oid)
+    raised = 0
+    while remaining:
+        # Bundle viable PRs which don't touch the same code together
+        batch_size = scheduler.wait_for_capacity()
+        batch = robodoge.conflicts.plan_batches(remaining, conflict_index, batch_size)[0]
         try:
-            raise_pull_request(conn, merger, pr_titles, viable_pr_ids)
+            raise_pull_request(conn, merger, pr_titles, batch)
+            raised += 1
         except robodoge.BranchCollisionError as err:
             print(err.msg)
+        scheduler.submitted()
+        remaining = [pr_id for pr_id in remaining if pr_id not in batch]
+    return raised
+
+config = robodoge.load_configuration('config.yml')
+try:
+    merger = robodoge.Robodoge(config)
+except robodoge.ConfigurationError as err:
+    print(err.msg)
+    sys.exit(1)
+
+# Pass --daemon to keep running, picking up newly pending PRs as they appear,
+# rather than exiting after one pass
+daemon = '--daemon' in sys.argv[1:]
+scheduler = robodoge.scheduler.BatchScheduler(merger, 'dogecoin/dogecoin', config.get('mass_test', {}))
+
+conn = merger.get_connection()
+try:
+    while True:
+        raised = run_pass(conn, merger, config, scheduler)
+        print('Raised %d pull request batches' % raised)
+        merger.repo.checkout(merger.safe_branch)
+        if not daemon:
+            break
+        time.sleep(scheduler.poll_interval)
 finally:
     conn.close()
-
-merger.repo.checkout(merger.safe_branch)
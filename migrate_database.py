@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+import robodoge
+import robodoge.migrations
+import sys
+
+# Script to apply pending schema migrations from db/migrations. Pass
+# --check-plans to then verify the hot queries still use their indexes.
+
+config = robodoge.load_configuration('config.yml')
+try:
+    merger = robodoge.Robodoge(config)
+except robodoge.ConfigurationError as err:
+    print(err.msg)
+    sys.exit(1)
+
+conn = merger.get_connection()
+try:
+    applied = robodoge.migrations.migrate(conn)
+    print('Applied %d migrations, schema is at version %d' % (len(applied), robodoge.migrations.get_schema_version(conn)))
+
+    if '--check-plans' in sys.argv[1:]:
+        failures = robodoge.migrations.check_query_plans(conn)
+        for (name, expected_index, indexes) in failures:
+            print('Query %s does not use index %s (uses: %s)' % (name, expected_index, ', '.join(indexes) or 'none'))
+        if failures:
+            sys.exit(1)
+        print('All hot queries use their indexes')
+finally:
+    conn.close()
@@ -1,14 +1,20 @@
-from io import BytesIO
+import contextlib
 import datetime
-import json
+import fcntl
+import hashlib
 import os.path
 import psycopg2
+import psycopg2.extras
 import pygit2
-import pycurl
 import subprocess
 import yaml
 from flask import Flask
 
+DEFAULT_BATCH_SIZE = 500
+
+# Records the hash of the inputs configure was last run against, in the build tree
+CONFIGURE_HASH_FILE = '.robodoge-configure-hash'
+
 coordinator = Flask(__name__)
 
 class Error(Exception):
@@ -47,8 +53,15 @@ class ConfigurationError(Error):
     def __str__(self):
         return repr(self.msg)
 
+# Imported here as the submodules use the exceptions above
+from . import buildcache, github, pool
+
 class Robodoge:
-    def __init__(self, config):
+    def __init__(self, config, path=None):
+        """
+        Set up from the given configuration. "path" overrides the Dogecoin
+        checkout to work in, for example a linked worktree of it.
+        """
         if not 'dogecoin_repo' in config:
             raise ConfigurationError('Missing "dogecoin_repo" section from configuration')
         if not 'committer' in config['dogecoin_repo']:
@@ -66,7 +79,12 @@ class Robodoge:
         if not 'http_auth' in config:
             raise ConfigurationError('Missing "http_auth" section from configuration')
 
-        self.repo = pygit2.Repository(config['dogecoin_repo']['path'] + os.path.sep + '.git')
+        if path:
+            self.path = path
+            self.repo = pygit2.Repository(path)
+        else:
+            self.path = config['dogecoin_repo']['path']
+            self.repo = pygit2.Repository(self.path + os.path.sep + '.git')
         self.config = config
         self.base_branch = self.repo.lookup_branch(config['dogecoin_repo']['branch'], pygit2.GIT_BRANCH_REMOTE)
         if not self.base_branch:
@@ -75,7 +93,14 @@ class Robodoge:
         self.committer = pygit2.Signature(config['dogecoin_repo']['committer']['name'], config['dogecoin_repo']['committer']['email'])
         self.git_username = 'rnicoll' # FIXME: Don't hardcode
         self.private_token = config['github']['private_token']
+        self.github = github.build_client(config['github'])
+        self.build_config = config.get('build', {})
+        self.build_cache = buildcache.build_cache(self.build_config)
         self.safe_branch = self.repo.lookup_branch('1.9-dev', pygit2.GIT_BRANCH_LOCAL) # FIXME: Don't hardcode
+        self.in_memory_merge = config['dogecoin_repo'].get('in_memory_merge', False)
+        fetch_config = config['dogecoin_repo'].get('fetch', {})
+        self.fetch_depth = fetch_config.get('depth', 0)
+        self.object_cache = fetch_config.get('object_cache')
 
     def apply_pull_requests(self, conn, head_branch, pr_ids):
         """
@@ -109,6 +134,63 @@ class Robodoge:
                 self.repo.lookup_reference('CHERRY_PICK_HEAD').delete()
         return True
 
+    def apply_pull_requests_in_memory(self, conn, head_branch, pr_ids):
+        """
+        Apply one or more pull requests to a branch, without touching the
+        working directory or index. Each commit is cherry-picked by merging
+        trees in memory; the branch is only moved once every commit has
+        applied cleanly, and is left untouched on conflict.
+        """
+        branch_ref = self.repo.lookup_reference('refs/heads/' + head_branch.branch_name)
+        head = self.repo.get(branch_ref.target)
+        for pr_id in pr_ids:
+            for commit_oid in get_commit_oids(conn, pr_id):
+                commit = self.repo.get(commit_oid)
+                # Cherry-pick is a three way merge against the commit's parent
+                index = self.repo.merge_trees(commit.parents[0].tree, head.tree, commit.tree)
+                if index.conflicts:
+                    return False
+                head_oid = self.repo.create_commit(
+                    None,
+                    commit.author, self.committer, commit.message,
+                    index.write_tree(self.repo),
+                    [head.id]
+                )
+                head = self.repo.get(head_oid)
+        branch_ref.set_target(head.id)
+        return True
+
+    def apply_pull_requests_to_branch(self, conn, branch, pr_ids, checkout):
+        """
+        Apply pull requests to a newly created branch. If merging in memory, the
+        branch is only checked out afterwards, and only if "checkout" is true;
+        otherwise it has to be checked out for the cherry-picks anyway.
+        """
+        if self.in_memory_merge:
+            if not self.apply_pull_requests_in_memory(conn, branch, pr_ids):
+                return False
+            if checkout:
+                self.repo.checkout(branch)
+            return True
+        else:
+            self.repo.checkout(branch)
+            return self.apply_pull_requests(conn, branch, pr_ids)
+
+    def build_checkout(self):
+        """
+        Compile and test the commit checked out at self.path. If a build cache
+        is configured, a cached result for the same tree is used instead of
+        building again.
+
+        Returns a BuildResult if the build cache is in use, otherwise None.
+        Raises BuildError subclasses in case of problems.
+        """
+        if not self.build_cache:
+            compile_dogecoin(self.path, self.build_config)
+            return None
+        tree_oid = self.repo.head.peel(pygit2.Commit).tree.id
+        return buildcache.compile_dogecoin_cached(self.build_cache, tree_oid, self.path, self.build_config)
+
     def build_pr_request(self, title, body, head_branch_name):
         """
         Raise a pull request against the given GitHub repository
@@ -122,28 +204,9 @@ class Robodoge:
 
     def call_github(self, url, request, method=None):
         """
-        Raise a pull request against the given GitHub repository
+        Send a request to the GitHub API, via the shared rate limit aware client
         """
-
-        buffer = BytesIO()
-        c = pycurl.Curl()
-        c.setopt(c.URL, url)
-        c.setopt(c.POSTFIELDS, json.dumps(request))
-        c.setopt(c.HTTPHEADER, ["Content-Type: application/json; charset=utf-8"])
-        c.setopt(c.USERNAME, self.private_token)
-        c.setopt(c.PASSWORD, 'x-oauth-basic')
-        c.setopt(c.WRITEDATA, buffer)
-        if method:
-            c.setopt(c.CUSTOMREQUEST, method)
-        else:
-            c.setopt(c.POST, 1)
-        c.perform()
-        status_code = c.getinfo(c.RESPONSE_CODE)
-        c.close()
-
-        if status_code < 200 or status_code> 299:
-            raise Error("Returned status from GitHub API was %d, expected 200-range status code" % status_code)
-        return json.loads(buffer.getvalue().decode('UTF-8'))
+        return self.github.call(url, request, method)
 
     def create_branch(self, branch_name):
         branch = self.repo.lookup_branch(branch_name, pygit2.GIT_BRANCH_LOCAL)
@@ -155,7 +218,51 @@ class Robodoge:
         else:
             raise BranchCollisionError('Branch %s already exists, aborting' % branch_name)
 
+    def fetch_pr(self, pr_number, base_ref, remote_name='upstream'):
+        """
+        Fetch only the given pull request and the branch it targets from the
+        remote, as remote branches "<remote>/pr/<number>" and "<remote>/<base_ref>",
+        rather than syncing every ref.
+
+        If an object cache is configured, the fetch goes into that shared bare
+        repository instead, which already holds most objects from earlier
+        fetches by any build on the host, so each fetch is one small pack. The
+        refs are then pointed at the fetched commits here, reading the objects
+        via git alternates. Otherwise the fetch is shallow if a depth is
+        configured.
+        """
+        refspecs = pr_refspecs(pr_number, base_ref, remote_name)
+        remote_url = self.repo.remotes[remote_name].url
+        if not self.object_cache:
+            if self.fetch_depth:
+                self.repo.remotes[remote_name].fetch(refspecs, depth=self.fetch_depth)
+            else:
+                self.repo.remotes[remote_name].fetch(refspecs)
+            return
+
+        with open_object_cache(self.object_cache, remote_name, remote_url) as cache_repo:
+            cache_repo.remotes[remote_name].fetch(refspecs)
+            add_alternate(self.repo, os.path.join(cache_repo.path, 'objects'))
+            for refspec in refspecs:
+                ref_name = refspec.split(':')[1]
+                self.repo.references.create(ref_name, cache_repo.references[ref_name].target, force=True)
+
     def get_connection(self):
+        return psycopg2.connect(self.get_dsn())
+
+    def get_connection_pool(self):
+        """
+        Build a thread-safe pool of database connections, sized by the optional
+        "pool" subsection of the "pgsql" section of the configuration.
+        """
+        pool_config = self.config['pgsql'].get('pool', {})
+        return pool.ConnectionPool(self.get_dsn(),
+            pool_config.get('min', pool.DEFAULT_MIN_CONNECTIONS),
+            pool_config.get('max', pool.DEFAULT_MAX_CONNECTIONS),
+            pool_config.get('checkout_timeout', pool.DEFAULT_CHECKOUT_TIMEOUT),
+            pool_config.get('health_check_interval', pool.DEFAULT_HEALTH_CHECK_INTERVAL))
+
+    def get_dsn(self):
         if 'pgsql' not in self.config:
             raise ConfigurationError("Expected 'pgsql' section in configuration.")
         
@@ -167,39 +274,268 @@ class Robodoge:
         if 'password' not in pgsql_config:
             raise Exception("Expected PostgreSQL password to be provided in configuration file.")
 
-        return psycopg2.connect("host=localhost dbname=%(db)s user=%(username)s password=%(password)s port=%(port)s" % pgsql_config)
+        return "host=localhost dbname=%(db)s user=%(username)s password=%(password)s port=%(port)s" % pgsql_config
 
     def raise_pr(self, repo_name, title, body, head_branch_name):
         request = self.build_pr_request(title, body, head_branch_name)
         url = 'https://api.github.com/repos/%s/pulls' % repo_name
         return self.call_github(url, request)
 
-def compile_dogecoin(path):
+def compile_dogecoin(path, build_config=None):
     """
     Compile the Dogecoin client found at the given path, and then run its unit tests.
-    
-    Raises BuildError subclasses in case of problems.
+
+    "build_config" is the optional "build" section of the configuration. If
+    "incremental" is set there, autogen.sh/configure are skipped when their
+    inputs are unchanged since the last build in this tree, and "make clean"
+    is only run if "clean" is also set. "ccache" wraps the compilers with ccache.
+
+    Make runs with "jobs" parallel jobs (default: the number of available
+    CPUs), starting no new jobs while the load average is above "max_load"
+    (default: the number of available CPUs). "targets" limits the build to
+    the given targets, for example "src/dogecoind"; "test_jobs" and
+    "test_targets" do the same for the unit test phase. "test_targets"
+    defaults to "check", which builds the whole tree; "src/check" runs only
+    the unit tests under src, and an empty list skips the test phase.
+
+    Returns the combined output of the build. Raises BuildError subclasses in
+    case of problems.
     """
 
+    if build_config is None:
+        build_config = {}
+    incremental = build_config.get('incremental', False)
+    clean = build_config.get('clean', not incremental)
+
+    log = []
     original_path = os.getcwd()
     os.chdir(path)
     try:
         try:
-            subprocess.check_output([path + os.path.sep + 'autogen.sh'])
-            subprocess.check_output([path + os.path.sep + 'configure'])
+            configure_hash = None
+            if incremental:
+                configure_hash = hash_configure_inputs(pygit2.Repository(path), build_config)
+            if not incremental or not is_configured(path, configure_hash):
+                env = None
+                if build_config.get('ccache', False):
+                    env = dict(os.environ)
+                    env['CC'] = 'ccache ' + env.get('CC', 'gcc')
+                    env['CXX'] = 'ccache ' + env.get('CXX', 'g++')
+                log.append(subprocess.check_output([path + os.path.sep + 'autogen.sh']))
+                log.append(subprocess.check_output([path + os.path.sep + 'configure'], env=env))
+                if configure_hash:
+                    with open(os.path.join(path, CONFIGURE_HASH_FILE), 'w') as f:
+                        f.write(configure_hash)
+            else:
+                print('Build configuration unchanged, skipping autogen.sh and configure')
         except subprocess.CalledProcessError as err:
             raise BuildSetupError(err)
         try:
-            subprocess.check_output(['make', 'clean'], stderr=subprocess.STDOUT)
-            subprocess.check_output(['make'], stderr=subprocess.STDOUT)
+            if clean:
+                log.append(subprocess.check_output(['make', 'clean'], stderr=subprocess.STDOUT))
+            for command in make_commands(build_config, build_config.get('targets', []), build_config.get('jobs')):
+                log.append(subprocess.check_output(command, stderr=subprocess.STDOUT))
         except subprocess.CalledProcessError as err:
             raise BuildMakeError(err)
-        try:
-            subprocess.check_output(['make', 'check'], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as err:
-            raise BuildTestError(err)
+        test_targets = build_config.get('test_targets', ['check'])
+        if test_targets:
+            try:
+                for command in make_commands(build_config, test_targets,
+                        build_config.get('test_jobs', build_config.get('jobs'))):
+                    log.append(subprocess.check_output(command, stderr=subprocess.STDOUT))
+            except subprocess.CalledProcessError as err:
+                raise BuildTestError(err)
+        else:
+            print('No test targets configured, skipping unit tests')
     finally:
         os.chdir(original_path)
+    return b''.join(log).decode('UTF-8', 'replace')
+
+def available_cpus():
+    """ Number of CPUs this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def make_commands(build_config, targets, jobs=None):
+    """
+    Build the make command lines for the given targets. Targets within a
+    subdirectory, such as "src/dogecoind", are built by running make in that
+    directory, as the top level Makefile doesn't know about them. An empty
+    list of targets builds the default target.
+    """
+    if not jobs:
+        jobs = available_cpus()
+    base_command = ['make', '-j', str(jobs), '-l', str(build_config.get('max_load', available_cpus()))]
+
+    directories = {}
+    for target in targets:
+        (directory, name) = os.path.split(target)
+        directories.setdefault(directory, []).append(name)
+    if not directories:
+        return [base_command]
+
+    commands = []
+    for (directory, names) in directories.items():
+        if directory:
+            commands.append(base_command + ['-C', directory] + names)
+        else:
+            commands.append(base_command + names)
+    return commands
+
+def hash_configure_inputs(repo, build_config):
+    """
+    Hash everything which feeds into autogen.sh/configure: configure.ac,
+    autogen.sh, the Makefile.am files and the local autoconf macros, plus the
+    configure-affecting build options.
+
+    Inputs are taken from the tree checked out at HEAD, so files generated by
+    autogen.sh (such as aclocal.m4) don't change the hash. Blob IDs stand in
+    for file contents, so nothing needs reading from disk.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(('ccache=%s\n' % build_config.get('ccache', False)).encode('UTF-8'))
+    for (filename, blob_id) in sorted(configure_inputs(repo, repo.head.peel(pygit2.Commit).tree)):
+        hasher.update(('%s %s\n' % (filename, blob_id)).encode('UTF-8'))
+    return hasher.hexdigest()
+
+def configure_inputs(repo, tree, prefix=''):
+    """ Generator over (path, blob ID) of the autogen.sh/configure inputs tracked in a tree """
+    for entry in tree:
+        if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+            for configure_input in configure_inputs(repo, repo[entry.id], prefix + entry.name + '/'):
+                yield configure_input
+        elif entry.name in ('configure.ac', 'autogen.sh', 'Makefile.am') or entry.name.endswith('.m4'):
+            yield (prefix + entry.name, str(entry.id))
+
+def is_configured(path, configure_hash):
+    """ Test whether the tree at the given path has been configured from inputs matching the hash """
+    if not os.path.isfile(os.path.join(path, 'Makefile')):
+        return False
+    try:
+        with open(os.path.join(path, CONFIGURE_HASH_FILE), 'r') as f:
+            return f.read().strip() == configure_hash
+    except OSError:
+        return False
+
+def pr_refspecs(pr_number, base_ref, remote_name='upstream'):
+    """ Refspecs fetching just a GitHub pull request and its base branch """
+    return [
+        '+refs/pull/%d/head:refs/remotes/%s/pr/%d' % (pr_number, remote_name, pr_number),
+        '+refs/heads/%s:refs/remotes/%s/%s' % (base_ref, remote_name, base_ref),
+    ]
+
+@contextlib.contextmanager
+def open_object_cache(path, remote_name, remote_url):
+    """
+    Open (creating if need be) a bare repository shared by every build on the
+    host as an object cache, holding an exclusive lock on it so concurrent
+    fetches don't collide.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, '.robodoge-lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.isfile(os.path.join(path, 'HEAD')):
+            repo = pygit2.Repository(path)
+        else:
+            repo = pygit2.init_repository(path, bare=True)
+        if remote_name not in [remote.name for remote in repo.remotes]:
+            repo.remotes.create(remote_name, remote_url)
+        yield repo
+
+def add_alternate(repo, objects_path):
+    """
+    Make the objects in another object store readable from the repository,
+    both to this process and to git commands run by the build.
+    """
+    # Linked worktrees share the main repository's object store
+    common_path = repo.path
+    commondir_file = os.path.join(repo.path, 'commondir')
+    if os.path.isfile(commondir_file):
+        with open(commondir_file, 'r') as f:
+            common_path = os.path.normpath(os.path.join(repo.path, f.read().strip()))
+    alternates_file = os.path.join(common_path, 'objects', 'info', 'alternates')
+    objects_path = os.path.abspath(objects_path)
+    alternates = []
+    if os.path.isfile(alternates_file):
+        with open(alternates_file, 'r') as f:
+            alternates = f.read().splitlines()
+    if objects_path in alternates:
+        return
+    if not os.path.isdir(os.path.dirname(alternates_file)):
+        os.makedirs(os.path.dirname(alternates_file))
+    with open(alternates_file, 'a') as f:
+        f.write(objects_path + '\n')
+    repo.odb.add_disk_alternate(objects_path)
+
+def test_pr_merge(conn, merger, pr_id):
+    """
+    Test if a pull request can be cleanly merged against the current development branch. Returns true/false
+    """
+    return test_pr_batch_merge(conn, merger, [pr_id])
+
+def test_pr_batch_merge(conn, merger, pr_ids):
+    """
+    Test if a batch of pull requests can be cleanly merged, in order, against
+    the current development branch, and the result builds. Returns true/false.
+    A BuildSetupError is raised rather than returning false, as it says
+    nothing about the pull requests.
+    """
+
+    repo = merger.repo
+
+    # Test if the branch exists already, create it if not
+    if len(pr_ids) == 1:
+        branch_name = 'bitcoin-pr-%d' % pr_ids[0]
+    else:
+        branch_name = 'bitcoin-prs-%s' % hashlib.sha1(','.join(str(pr_id) for pr_id in pr_ids).encode('UTF-8')).hexdigest()[:12]
+    head_branch = merger.create_branch(branch_name)
+    if not head_branch:
+        return False
+    try:
+        if not merger.apply_pull_requests_to_branch(conn, head_branch, pr_ids, True):
+            return False
+
+        # Make sure it's a viable build too
+        print('Attempting compilation of PRs %s' % ', '.join(str(pr_id) for pr_id in pr_ids))
+        try:
+            merger.build_checkout()
+        except BuildSetupError:
+            raise
+        except BuildError:
+            return False
+    finally:
+        repo.checkout(merger.safe_branch)
+        repo.lookup_branch(head_branch.branch_name, pygit2.GIT_BRANCH_LOCAL).delete()
+
+    return True
+
+def group_test_pr_merges(conn, merger, pr_ids, base_pr_ids=None):
+    """
+    Find which of a batch of pull requests can be merged and built, applied
+    in order on top of "base_pr_ids" (already known to be viable).
+
+    The whole batch is applied and built once. Only if that fails is it split
+    in half, and each half tested the same way, to isolate the pull requests
+    responsible. Where most pull requests are fine, this takes far fewer
+    builds than testing each individually.
+
+    Returns the viable pull request IDs, in order.
+    """
+    if not pr_ids:
+        return []
+    if base_pr_ids is None:
+        base_pr_ids = []
+    if test_pr_batch_merge(conn, merger, base_pr_ids + pr_ids):
+        return pr_ids
+    if len(pr_ids) == 1:
+        print('PR %d cannot be merged and built' % pr_ids[0])
+        return []
+    middle = len(pr_ids) // 2
+    viable_pr_ids = group_test_pr_merges(conn, merger, pr_ids[:middle], base_pr_ids)
+    viable_pr_ids += group_test_pr_merges(conn, merger, pr_ids[middle:], base_pr_ids + viable_pr_ids)
+    return viable_pr_ids
 
 def get_commit_oids(conn, pr_id):
     """ Retrieve the commit OIDs for the given pull request """
@@ -235,6 +571,25 @@ def load_configuration(filename):
 
   return config
 
+def parse_github_timestamp(value):
+    """ Parse a timestamp as formatted by the GitHub API """
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+def get_import_high_water_mark(cursor, project):
+    """ Retrieve the newest "updated_at" timestamp previously imported for a project, or None """
+    cursor.execute("SELECT last_updated_at FROM import_state WHERE project=%(project)s", {'project': project})
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    return None
+
+def set_import_high_water_mark(cursor, project, updated_at):
+    """ Record the newest "updated_at" timestamp imported for a project """
+    cursor.execute("""INSERT INTO import_state (project, last_updated_at)
+         VALUES (%(project)s, %(updated_at)s)
+         ON CONFLICT (project) DO UPDATE SET last_updated_at=EXCLUDED.last_updated_at""",
+         {'project': project, 'updated_at': updated_at})
+
 def extract_pr_data(pr, project):
     """ Extract data from a pull request for insertion/update into the database """
     data = {
@@ -248,7 +603,7 @@ def extract_pr_data(pr, project):
        'body': pr['body'].replace("\r\n", "\n"),
        'merge_commit_sha': pr['merge_commit_sha'],
        'base_ref': pr['base']['ref'],
-       'created_at': datetime.datetime.strptime(pr['created_at'], '%Y-%m-%dT%H:%M:%SZ'),
+       'created_at': parse_github_timestamp(pr['created_at']),
     }
     if pr['assignee']:
         data['assignee_login'] = pr['assignee']['login']
@@ -259,7 +614,7 @@ def extract_pr_data(pr, project):
     else:
         data['milestone_title'] = None
     if pr['merged_at']:
-        data['merged_at'] = datetime.datetime.strptime(pr['merged_at'], '%Y-%m-%dT%H:%M:%SZ')
+        data['merged_at'] = parse_github_timestamp(pr['merged_at'])
     else:
         data['merged_at'] = None
     if pr['user']:
@@ -282,3 +637,40 @@ def update_pr(cursor, pr, project):
     cursor.execute("""UPDATE pull_request
          SET number=%(number)s, state=%(state)s, title=%(title)s, assignee_login=%(assignee_login)s, milestone_title=%(milestone_title)s, merged_at=%(merged_at)s, merge_commit_sha=%(merge_commit_sha)s
          WHERE id=%(id)s""", data)
+
+PR_COLUMNS = ('id', 'number', 'project', 'url', 'html_url', 'state', 'title', 'user_login', 'assignee_login', 'milestone_title', 'base_ref', 'body', 'created_at', 'merged_at', 'merge_commit_sha')
+PR_UPDATE_COLUMNS = ('number', 'state', 'title', 'assignee_login', 'milestone_title', 'merged_at', 'merge_commit_sha')
+
+def get_existing_pr_ids(cursor, pr_ids):
+    """ Return the set of the given pull request IDs which are already in the database """
+    cursor.execute("SELECT id FROM pull_request WHERE id = ANY(%(ids)s)", {'ids': list(pr_ids)})
+    return set(row[0] for row in cursor.fetchall())
+
+def write_prs(cursor, prs, project, update=True, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert pull requests into the database in batches. Pull requests which
+    already exist are updated if "update" is true, otherwise left untouched.
+    """
+    write_pr_rows(cursor, [extract_pr_data(pr, project) for pr in prs], update, batch_size)
+
+def write_pr_rows(cursor, rows, update=True, batch_size=DEFAULT_BATCH_SIZE):
+    """ As write_prs(), but for rows already converted by extract_pr_data() """
+    if update:
+        conflict = 'DO UPDATE SET ' + ', '.join('%s=EXCLUDED.%s' % (column, column) for column in PR_UPDATE_COLUMNS)
+    else:
+        conflict = 'DO NOTHING'
+    psycopg2.extras.execute_values(cursor,
+        """INSERT INTO pull_request (%s) VALUES %%s ON CONFLICT (id) %s""" % (', '.join(PR_COLUMNS), conflict),
+        rows,
+        template='(' + ', '.join('%%(%s)s' % column for column in PR_COLUMNS) + ')',
+        page_size=batch_size)
+
+def write_commits(cursor, commits, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert pull request commits into the database in batches. Takes a list
+    of (pr_id, ordinality, sha) tuples; commits already recorded are skipped.
+    """
+    psycopg2.extras.execute_values(cursor,
+        """INSERT INTO pull_request_commit (pr_id, ordinality, sha) VALUES %s
+             ON CONFLICT (pr_id, sha) DO NOTHING""",
+        commits, page_size=batch_size)
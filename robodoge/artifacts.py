@@ -0,0 +1,201 @@
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+from . import Error
+
+DEFAULT_CONCURRENCY = 4
+# Compressed artifacts larger than this are uploaded in parts, which S3 requires to be at least 5MB
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+class ArtifactError(Error):
+    """ Error uploading build artifacts """
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class LocalStore:
+    """ Artifact storage in a local directory, for testing or single host setups """
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.path, key))
+
+    def put(self, key, f, size, content_encoding=None, multipart=False):
+        """ Store the contents of the open file "f" under the key """
+        destination = os.path.join(self.path, key)
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # Write then rename, so a concurrent exists() never sees a partial file
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(destination), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(f, out)
+        os.rename(tmp_path, destination)
+
+    def url(self, key):
+        return 'file://' + os.path.abspath(os.path.join(self.path, key))
+
+class S3Store:
+    """
+    Artifact storage in an S3 bucket. One connection is opened and shared by
+    every upload; boto pools the underlying HTTP connections. S3 and network
+    errors are raised as ArtifactError.
+    """
+    def __init__(self, bucket_name, connection=None):
+        import boto
+        import boto.exception
+        self.errors = (boto.exception.BotoServerError, boto.exception.BotoClientError, OSError)
+        self.connection = connection or boto.connect_s3()
+        self.bucket_name = bucket_name
+        try:
+            self.bucket = self.connection.get_bucket(bucket_name)
+        except self.errors as err:
+            raise ArtifactError('Could not open S3 bucket %s: %s' % (bucket_name, err))
+
+    def exists(self, key):
+        try:
+            return self.bucket.get_key(key) is not None
+        except self.errors as err:
+            raise ArtifactError('Could not check for %s in S3: %s' % (key, err))
+
+    def put(self, key, f, size, content_encoding=None, multipart=False, part_size=DEFAULT_PART_SIZE):
+        """ Store the contents of the open file "f" under the key """
+        try:
+            self._put(key, f, size, content_encoding, multipart, part_size)
+        except self.errors as err:
+            raise ArtifactError('Could not upload %s to S3: %s' % (key, err))
+
+    def _put(self, key, f, size, content_encoding, multipart, part_size):
+        headers = {'Content-Encoding': content_encoding} if content_encoding else {}
+        if not multipart:
+            from boto.s3.key import Key
+            s3_key = Key(self.bucket)
+            s3_key.key = key
+            s3_key.set_contents_from_file(f, headers=headers, size=size, rewind=True)
+            s3_key.close()
+            return
+
+        upload = self.bucket.initiate_multipart_upload(key, headers=headers)
+        try:
+            part_number = 1
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                upload.upload_part_from_file(f, part_number, size=min(part_size, size - offset))
+                part_number += 1
+                offset += part_size
+            upload.complete_upload()
+        except:
+            try:
+                upload.cancel_upload()
+            except self.errors as err:
+                # Report the original failure rather than this one
+                print('Could not cancel multipart upload of %s: %s' % (key, err))
+            raise
+
+    def url(self, key):
+        return 'arn:aws:s3:::' + self.bucket_name + '/' + key
+
+class ArtifactUploader:
+    """
+    Uploads build artifacts to a store, concurrently. Artifacts are stored
+    once per content, under the SHA-256 of the uncompressed file, so
+    uploading a binary identical to one already stored (e.g. a rebuild of the
+    same tree) only costs the existence check. Each set of artifacts also
+    gets a manifest mapping artifact names to stored keys.
+    """
+    def __init__(self, store, prefix, concurrency=DEFAULT_CONCURRENCY, compress=True,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD):
+        self.store = store
+        self.prefix = prefix
+        self.concurrency = concurrency
+        self.compress = compress
+        self.multipart_threshold = multipart_threshold
+
+    def object_key(self, digest):
+        return '%s/sha256/%s%s' % (self.prefix, digest, '.gz' if self.compress else '')
+
+    def upload_file(self, path):
+        """ Upload one file unless its content is already stored, returning its key """
+        digest = hash_file(path)
+        key = self.object_key(digest)
+        if self.store.exists(key):
+            print('%s already uploaded as %s' % (path, key))
+            return key
+
+        with tempfile.TemporaryFile() as f:
+            if self.compress:
+                with open(path, 'rb') as source, gzip.GzipFile(fileobj=f, mode='wb') as compressed:
+                    shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+                content_encoding = 'gzip'
+            else:
+                with open(path, 'rb') as source:
+                    shutil.copyfileobj(source, f, CHUNK_SIZE)
+                content_encoding = None
+            size = f.tell()
+            f.seek(0)
+            print('Uploading %s to %s (%d bytes)' % (path, key, size))
+            self.store.put(key, f, size, content_encoding, multipart=size > self.multipart_threshold)
+        return key
+
+    def upload(self, artifacts, name):
+        """
+        Upload a map of artifact name (e.g. "src/dogecoind") to file path, plus
+        a manifest stored as "<prefix>/<name>/manifest.json". Returns a map
+        of artifact name to the URL of the stored copy.
+        """
+        missing = [path for path in artifacts.values() if not os.path.isfile(path)]
+        if missing:
+            raise ArtifactError('Build artifacts not found: ' + ', '.join(missing))
+
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            futures = dict((artifact, executor.submit(self.upload_file, path)) for (artifact, path) in artifacts.items())
+            keys = dict((artifact, future.result()) for (artifact, future) in futures.items())
+
+        manifest = json.dumps({
+            'compression': 'gzip' if self.compress else None,
+            'artifacts': keys,
+        }, sort_keys=True).encode('UTF-8')
+        with tempfile.TemporaryFile() as f:
+            f.write(manifest)
+            f.seek(0)
+            self.store.put('%s/%s/manifest.json' % (self.prefix, name), f, len(manifest))
+        return dict((artifact, self.store.url(key)) for (artifact, key) in keys.items())
+
+def hash_file(path):
+    """ SHA-256 of a file's contents, as hex """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_uploader(config):
+    """
+    Build the artifact uploader described by the "artifacts" configuration
+    section, storing to the bucket in the "s3" section unless the backend is
+    "local".
+    """
+    artifacts_config = config.get('artifacts', {})
+    backend = artifacts_config.get('backend', 's3')
+    if backend == 'local':
+        store = LocalStore(artifacts_config['path'])
+    elif backend == 's3':
+        store = S3Store(config['s3']['bucket'])
+    else:
+        raise ArtifactError('Unknown artifact storage backend "%s"' % backend)
+    prefix = artifacts_config.get('prefix', config.get('s3', {}).get('client_path', 'robodoge'))
+    return ArtifactUploader(store, prefix,
+        artifacts_config.get('concurrency', DEFAULT_CONCURRENCY),
+        artifacts_config.get('compress', True),
+        artifacts_config.get('multipart_threshold', DEFAULT_MULTIPART_THRESHOLD))
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+from . import BuildError, BuildMakeError, BuildSetupError, BuildTestError
+
+DEFAULT_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+DEFAULT_ARTIFACTS = ['src/dogecoind', 'src/dogecoin-cli', 'src/dogecoin-tx']
+
+# Build stages, in order, and the error raised when each fails
+STAGES = [
+    ('setup', BuildSetupError),
+    ('make', BuildMakeError),
+    ('test', BuildTestError),
+]
+
+class BuildResult:
+    """ Outcome of building a source tree, as recorded in the build cache """
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+    @property
+    def succeeded(self):
+        return self.data['failed_stage'] is None
+
+    @property
+    def artifacts(self):
+        """ Map of artifact name (e.g. "src/dogecoind") to the path of its cached copy """
+        return dict((name, os.path.join(self.path, filename)) for (name, filename) in self.data['artifacts'].items())
+
+    @property
+    def log(self):
+        with open(os.path.join(self.path, 'build.log'), 'r') as f:
+            return f.read()
+
+    def stage_passed(self, stage):
+        """ Test whether the given stage ("setup", "make" or "test") passed """
+        if self.succeeded:
+            return True
+        names = [name for (name, error) in STAGES]
+        return names.index(stage) < names.index(self.data['failed_stage'])
+
+    def raise_if_failed(self):
+        """ Raise the same BuildError subclass the original build raised, if it failed """
+        for (name, error) in STAGES:
+            if name == self.data['failed_stage']:
+                raise error(self.log)
+
+class BuildCache:
+    """
+    Local cache of build results, keyed by the git tree OID of the source
+    built (plus the build options which change what gets built). Each entry
+    records pass/fail per stage, the build log, and copies of the built
+    artifacts. Entries are evicted least recently used first once the cache
+    exceeds max_size bytes on disk.
+
+    Entries are written to a temporary directory and renamed into place, so
+    several processes (e.g. worktree pool workers) may share one cache.
+    """
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, tree_oid, build_config):
+        """ Cache key for a tree built with the given build options """
+        options = {
+            'targets': build_config.get('targets', []),
+            'test_targets': build_config.get('test_targets', ['check']),
+            'artifacts': build_config.get('artifacts', DEFAULT_ARTIFACTS),
+        }
+        options_hash = hashlib.sha1(json.dumps(options, sort_keys=True).encode('UTF-8')).hexdigest()
+        return '%s-%s' % (tree_oid, options_hash[:12])
+
+    def get(self, key):
+        """ Return the cached BuildResult for a key, or None """
+        entry_path = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry_path, 'result.json'), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Touch the entry so eviction treats it as recently used
+        os.utime(entry_path)
+        return BuildResult(entry_path, data)
+
+    def put(self, key, build_path, failed_stage, log, artifacts):
+        """
+        Record the result of a build. "artifacts" lists paths relative to the
+        build tree to copy into the cache; only those which exist are kept.
+        """
+        tmp_path = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        data = {
+            'failed_stage': failed_stage,
+            'created': time.time(),
+            'artifacts': {},
+        }
+        for name in artifacts:
+            source = os.path.join(build_path, name)
+            if os.path.isfile(source):
+                filename = name.replace(os.path.sep, '_')
+                shutil.copy2(source, os.path.join(tmp_path, filename))
+                data['artifacts'][name] = filename
+        with open(os.path.join(tmp_path, 'build.log'), 'w') as f:
+            f.write(log)
+        with open(os.path.join(tmp_path, 'result.json'), 'w') as f:
+            json.dump(data, f)
+
+        entry_path = os.path.join(self.path, key)
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another process cached the same tree first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+        return self.get(key)
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is within its size limit """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+            total += size
+        entries.sort()
+        for (mtime, size, entry_path) in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total -= size
+
+def compile_dogecoin_cached(cache, tree_oid, path, build_config=None):
+    """
+    Compile and test the Dogecoin client at the given path via
+    compile_dogecoin(), unless a result for the same tree is already cached.
+    "tree_oid" must be the tree of the commit checked out at the path.
+
+    Returns a BuildResult, whose artifacts should be used in preference to
+    the build tree's. Raises BuildError subclasses in case of problems,
+    including cached failures.
+    """
+    # Imported here to avoid a circular import, as the package imports this module
+    from . import compile_dogecoin
+
+    if build_config is None:
+        build_config = {}
+    key = cache.key(tree_oid, build_config)
+    result = cache.get(key)
+    if result:
+        print('Using cached build result for tree %s' % tree_oid)
+        result.raise_if_failed()
+        return result
+
+    artifacts = build_config.get('artifacts', DEFAULT_ARTIFACTS)
+    try:
+        log = compile_dogecoin(path, build_config)
+    except BuildError as err:
+        failed_stage = [name for (name, error) in STAGES if isinstance(err, error)][0]
+        output = getattr(err.cause, 'output', None) or b''
+        cache.put(key, path, failed_stage, output.decode('UTF-8', 'replace'), [])
+        raise
+    return cache.put(key, path, None, log, artifacts)
+
+def build_cache(build_config):
+    """ Build the build result cache described by the "build" configuration section, if any """
+    if 'cache_path' not in build_config:
+        return None
+    return BuildCache(build_config['cache_path'], build_config.get('cache_size', DEFAULT_CACHE_SIZE))
@@ -0,0 +1,73 @@
+import collections
+import threading
+import time
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 60
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache, evicting the least recently used entry once
+    it holds "max_entries", and expiring entries "ttl" seconds after they
+    were stored.
+
+    Every invalidation bumps a generation counter. Callers read it before
+    computing a value and pass it to put(), which discards the value if an
+    invalidation happened in the meantime, so a slow read racing a write can
+    never put stale data back into the cache.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """ Return the value stored for the key, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation):
+        """ Store a value computed after reading "generation", unless anything has been invalidated since """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, matches):
+        """ Remove every entry whose key "matches(key)" returns true for """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in [key for key in self.entries if matches(key)]:
+                del self.entries[key]
+
+    def clear(self):
+        self.invalidate(lambda key: True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,194 @@
+from io import BytesIO
+import json
+import pycurl
+import threading
+import time
+
+from . import Error
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF = 1
+
+# Failures where the request can't have reached the coordinator, so any call may be retried
+CONNECT_ERRORS = (pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT)
+# Statuses worth retrying: the coordinator, or a proxy in front of it, is briefly unavailable
+RETRY_STATUSES = (502, 503, 504)
+
+class CoordinatorError(Error):
+    """ Error returned by, or while talking to, the merger coordinator """
+    def __init__(self, msg, status_code=None):
+        self.msg = msg
+        self.status_code = status_code
+    def __str__(self):
+        return repr(self.msg)
+
+class CallStats:
+    """ Running latency totals for one kind of coordinator call """
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, failed=False):
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def __str__(self):
+        mean = self.seconds / self.count if self.count else 0.0
+        return '%d calls, %d failed, mean %.3fs, max %.3fs' % (self.count, self.failures, mean, self.max_seconds)
+
+class CoordinatorClient:
+    """
+    Client for the merger coordinator's API, as used by build nodes.
+
+    One curl handle is kept for the life of the client, so calls reuse its
+    keep-alive connection and TLS session rather than handshaking each time.
+    Failed calls are retried with exponential backoff; calls which are not
+    safe to repeat (such as claims) are only retried when the request can't
+    have reached the coordinator. Latency is recorded per operation.
+
+    Calls are serialized, so the client may be shared with a LeaseHeartbeat
+    thread.
+    """
+    def __init__(self, url, username, password, cainfo=None, timeout=DEFAULT_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, sleep=time.sleep):
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.cainfo = cainfo
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.curl = pycurl.Curl()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _perform(self, path, request, timeout):
+        """ Make one POST of the request, returning (status code, body) """
+        c = self.curl
+        # Resets options only; the connection and TLS session stay cached on the handle
+        c.reset()
+        buffer = BytesIO()
+        c.setopt(c.URL, self.url + path)
+        c.setopt(c.POSTFIELDS, json.dumps(request))
+        c.setopt(c.HTTPHEADER, ["Content-Type: application/json; charset=utf-8"])
+        c.setopt(c.USERNAME, self.username)
+        c.setopt(c.PASSWORD, self.password)
+        if self.cainfo:
+            c.setopt(c.CAINFO, self.cainfo)
+        c.setopt(c.WRITEDATA, buffer)
+        c.setopt(c.POST, 1)
+        c.setopt(c.CONNECTTIMEOUT, self.connect_timeout)
+        c.setopt(c.TIMEOUT, timeout)
+        c.perform()
+        return (c.getinfo(c.RESPONSE_CODE), buffer.getvalue())
+
+    def call(self, path, request, timeout=None, idempotent=True):
+        """ POST a request to the coordinator, returning the decoded JSON response """
+        name = request.get('operation', path)
+        stats = self.stats.setdefault(name, CallStats())
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                with self.lock:
+                    (status_code, body) = self._perform(path, request, timeout or self.timeout)
+            except pycurl.error as err:
+                stats.record(time.time() - started, True)
+                retry = idempotent or err.args[0] in CONNECT_ERRORS
+                if not retry or attempt >= self.max_retries:
+                    raise CoordinatorError('Could not reach merger coordinator: %s' % err.args[1])
+            else:
+                failed = status_code < 200 or status_code > 299
+                stats.record(time.time() - started, failed)
+                if not failed:
+                    return json.loads(body.decode('UTF-8'))
+                retry = idempotent and status_code in RETRY_STATUSES
+                if not retry or attempt >= self.max_retries:
+                    raise CoordinatorError("Returned status from merger coordinator was %d, expected 200-range status code" % status_code, status_code)
+            delay = self.backoff * (2 ** attempt)
+            print('Merger coordinator call %s failed, retrying in %d seconds' % (name, delay))
+            self.sleep(delay)
+            attempt += 1
+
+    def claim_next(self, wait=0):
+        """
+        Claim the next buildable PR, waiting up to "wait" seconds for one to
+        become available. Returns the PR, with the claim's "lease_duration" in
+        seconds added, or None if there is none.
+        """
+        request = {'operation': 'claim_next', 'wait': wait}
+        # Allow for the coordinator holding the request open
+        result = self.call('/automerge/api/v1.0/pr/claim_next', request, timeout=wait + self.timeout, idempotent=False)
+        if 'result' in result and result['result'] == 'ok':
+            pr = result['pr']
+            pr['lease_duration'] = result.get('lease_duration')
+            return pr
+        return None
+
+    def update_pr(self, pr_id, request):
+        return self.call('/automerge/api/v1.0/pr/' + str(pr_id), request)
+
+    def heartbeat(self, pr_id):
+        """ Extend our build lease on a PR, returning false if the lease has been lost """
+        result = self.update_pr(pr_id, {'operation': 'heartbeat'})
+        return 'result' in result and result['result'] == 'ok'
+
+    def report_build_success(self, pr_id, s3_arn):
+        return self.update_pr(pr_id, {'operation': 'build_success', 's3_arn': s3_arn})
+
+    def report_build_failed(self, pr_id):
+        return self.update_pr(pr_id, {'operation': 'build_failed'})
+
+    def close(self):
+        self.curl.close()
+
+class LeaseHeartbeat:
+    """
+    Context manager sending heartbeats for a build lease from a background
+    thread, every third of the lease duration, until the block exits. Failed
+    heartbeats are reported but don't interrupt the build; if the lease is
+    lost, the coordinator will have returned the PR to the queue.
+    """
+    def __init__(self, client, pr_id, lease_duration):
+        self.client = client
+        self.pr_id = pr_id
+        self.interval = max(1, lease_duration / 3)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.client.heartbeat(self.pr_id):
+                    print('Build lease on PR %d has been lost' % self.pr_id)
+            except CoordinatorError as err:
+                print('Could not send heartbeat for PR %d: %s' % (self.pr_id, err))
+
+def build_coordinator_client(config):
+    """ Build a coordinator client from the "coordinator" and "http_auth" configuration sections """
+    coordinator_config = config['coordinator']
+    return CoordinatorClient(coordinator_config['url'],
+        config['http_auth']['user'], config['http_auth']['password'],
+        coordinator_config.get('cainfo'),
+        coordinator_config.get('timeout', DEFAULT_TIMEOUT),
+        coordinator_config.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT),
+        coordinator_config.get('max_retries', DEFAULT_MAX_RETRIES))
@@ -0,0 +1,132 @@
+import psycopg2.extras
+
+from . import *
+
+# Hunks closer than this many lines are treated as overlapping, as git
+# will usually fail to merge changes to adjacent lines cleanly
+HUNK_MARGIN = 3
+
+# Line range recorded for changes with no hunks (binary files, mode changes),
+# which overlap any other change to the same file
+WHOLE_FILE = (0, 2147483647)
+
+def commit_hunks(repo, commit):
+    """
+    Return (path, first line, last line) for each hunk changed by a commit,
+    with line numbers in the commit's parent.
+    """
+    if not commit.parents:
+        return []
+    hunks = []
+    diff = repo.diff(commit.parents[0], commit, context_lines=0)
+    for patch in diff:
+        paths = set([patch.delta.old_file.path, patch.delta.new_file.path])
+        if not patch.hunks:
+            ranges = [WHOLE_FILE]
+        else:
+            ranges = [(hunk.old_start, hunk.old_start + max(hunk.old_lines, 1) - 1) for hunk in patch.hunks]
+        for path in paths:
+            for (start, end) in ranges:
+                hunks.append((path, start, end))
+    return hunks
+
+def update_conflict_index(conn, repo):
+    """
+    Record the paths and hunks touched by every commit not yet indexed.
+    Commits not (yet) present in the repository are skipped, and picked up
+    by a later run once they've been fetched.
+
+    Returns the number of commits indexed.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""SELECT pr_id, sha
+                          FROM pull_request_commit
+                          WHERE paths_indexed='f'""")
+        commits = cursor.fetchall()
+
+        indexed = []
+        rows = []
+        for (pr_id, sha) in commits:
+            try:
+                commit = repo.get(sha)
+            except ValueError:
+                commit = None
+            if not commit:
+                continue
+            rows.extend((pr_id, sha, path, start, end) for (path, start, end) in commit_hunks(repo, commit))
+            indexed.append((pr_id, sha))
+
+        if rows:
+            psycopg2.extras.execute_values(cursor,
+                """INSERT INTO pull_request_commit_path (pr_id, sha, path, hunk_start, hunk_end) VALUES %s""",
+                rows, page_size=DEFAULT_BATCH_SIZE)
+        if indexed:
+            psycopg2.extras.execute_values(cursor,
+                """UPDATE pull_request_commit commit
+                   SET paths_indexed='t'
+                   FROM (VALUES %s) AS indexed (pr_id, sha)
+                   WHERE commit.pr_id=indexed.pr_id AND commit.sha=indexed.sha""",
+                indexed, page_size=DEFAULT_BATCH_SIZE)
+        conn.commit()
+    finally:
+        cursor.close()
+    return len(indexed)
+
+def load_conflict_index(conn, pr_ids):
+    """
+    Load the paths and hunks touched by the commits still to merge for each
+    of the given pull requests, as a dict of PR ID to a dict of path to a
+    list of (first line, last line) tuples.
+    """
+    index = dict((pr_id, {}) for pr_id in pr_ids)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""SELECT path.pr_id, path.path, path.hunk_start, path.hunk_end
+                          FROM pull_request_commit_path path
+                              JOIN pull_request_commit commit ON commit.pr_id=path.pr_id AND commit.sha=path.sha
+                          WHERE path.pr_id = ANY(%(pr_ids)s)
+                              AND commit.to_merge='t'
+                              AND commit.merged='f'""", {'pr_ids': list(pr_ids)})
+        for (pr_id, path, start, end) in cursor:
+            index[pr_id].setdefault(path, []).append((start, end))
+    finally:
+        cursor.close()
+    return index
+
+def prs_overlap(a, b):
+    """ Test whether two entries from the conflict index touch overlapping hunks of any file """
+    for (path, a_ranges) in a.items():
+        if path not in b:
+            continue
+        for (a_start, a_end) in a_ranges:
+            for (b_start, b_end) in b[path]:
+                if a_start <= b_end + HUNK_MARGIN and b_start <= a_end + HUNK_MARGIN:
+                    return True
+    return False
+
+def plan_batches(pr_ids, index, batch_size):
+    """
+    Group pull requests into batches of at most batch_size, such that no two
+    pull requests in a batch touch overlapping hunks. Pull requests which
+    overlap one already in the batch are deferred to a later batch, as is
+    anything overlapping a deferred pull request, so overlapping changes are
+    always applied in their original order.
+
+    Returns a list of batches, each a list of pull request IDs in order.
+    """
+    batches = []
+    remaining = list(pr_ids)
+    while remaining:
+        batch = []
+        deferred = []
+        for pr_id in remaining:
+            entry = index.get(pr_id, {})
+            if len(batch) < batch_size \
+                    and not any(prs_overlap(entry, index.get(other, {})) for other in batch + deferred):
+                batch.append(pr_id)
+            else:
+                deferred.append(pr_id)
+        batches.append(batch)
+        remaining = deferred
+    return batches
@@ -1,8 +1,13 @@
 #!/usr/bin/python3
-from flask import Flask, jsonify, request, make_response, abort
+from flask import Flask, Response, jsonify, request, make_response, abort
 import psycopg2
 import psycopg2.extras
+import sys
+import threading
+import time
 from . import *
+from . import cache, outbox
+from .listener import NotificationListener
 
 app = Flask(__name__)
 config = load_configuration('/var/www/robodoge/config.yml')
@@ -11,59 +16,300 @@ try:
 except ConfigurationError as err:
     print(err.msg)
     sys.exit(1)
+db_pool = merger.get_connection_pool()
+# Started on first request, so it runs in the serving process rather than any parent it forked from
+listener = NotificationListener(merger.get_dsn(), ['build_ready', 'pull_request_changed'])
+# Serialized GET responses, dropped when the PRs they cover change
+response_cache = cache.TTLCache(config.get('coordinator', {}).get('cache_size', cache.DEFAULT_MAX_ENTRIES),
+    config.get('coordinator', {}).get('cache_ttl', cache.DEFAULT_TTL))
+
+PR_FIELDS = "id, number, url,state,title,user_login,html_url,assignee_login,milestone_title,base_ref, build_node, s3_arn, test_node"
+PR_FIELD_NAMES = [field.strip() for field in PR_FIELDS.split(',')]
+NOT_CLOSED_PR_CONDITION = "project='dogecoin/dogecoin' and state!='closed'"
+BUILDABLE_PR_CONDITION = "project='dogecoin/dogecoin' and state='open' and assignee_login is null and milestone_title='1.9' and base_ref='1.9-dev' and build_node IS NULL"
+
+# Page size for the list endpoints when the caller doesn't give a limit, and the most a caller may ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Longest a build node may hold a claim_next request open waiting for work, in seconds
+MAX_CLAIM_WAIT = 60
+
+# Seconds a build claim lasts without a heartbeat, and between checks for expired claims
+DEFAULT_LEASE_DURATION = 10 * 60
+DEFAULT_REAP_INTERVAL = 60
+lease_duration = config.get('coordinator', {}).get('lease_duration', DEFAULT_LEASE_DURATION)
+reap_interval = config.get('coordinator', {}).get('reap_interval', DEFAULT_REAP_INTERVAL)
+
+def invalidate_pr(pr_id):
+    """
+    Drop cached responses which may include the given PR: the PR itself, and
+    list pages starting before it. Pages starting after it can't include it,
+    as lists are in ID order.
+    """
+    def matches(key):
+        if key[0] == 'pr':
+            return key[1] == pr_id
+        return key[0] == 'list' and key[2] < pr_id
+    response_cache.invalidate(matches)
+
+def pr_changed(payload):
+    """ Listener callback for pull_request_changed notifications, from importers or other coordinators """
+    if payload is None:
+        # Notifications may have been missed
+        response_cache.clear()
+    else:
+        invalidate_pr(int(payload))
+
+listener.add_callback('pull_request_changed', pr_changed)
+
+reaper_lock = threading.Lock()
+reaper_thread = None
+
+@app.before_request
+def start_background_threads():
+    global reaper_thread
+    listener.start()
+    with reaper_lock:
+        if not reaper_thread:
+            reaper_thread = threading.Thread(target=run_reaper, daemon=True)
+            reaper_thread.start()
+
+def reap_expired_leases():
+    """
+    Return PRs whose build lease has expired, because the node building them
+    died or lost touch, to the build queue, and queue removing their GitHub
+    assignee. Returns the IDs of the PRs returned.
+
+    Safe to run from several coordinator processes at once; a lease extended
+    by a concurrent heartbeat is no longer expired when the delete re-checks it.
+
+    Locks are taken in the same order as claims and build reports (the
+    pull_request row, then its build_lease row), so reaping a lease as its
+    build reports in can't deadlock. PRs locked by a report in progress are
+    skipped, and looked at again on the next run.
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""SELECT pr.id
+                              FROM pull_request pr
+                                  JOIN build_lease lease ON lease.pr_id=pr.id
+                              WHERE lease.expires < NOW()
+                              FOR UPDATE OF pr SKIP LOCKED""")
+            locked_ids = [row[0] for row in cursor.fetchall()]
+            expired = []
+            if locked_ids:
+                cursor.execute("""DELETE FROM build_lease
+                                  WHERE pr_id = ANY(%(ids)s) AND expires < NOW()
+                                  RETURNING pr_id""", {'ids': locked_ids})
+                expired_ids = [row[0] for row in cursor.fetchall()]
+                if expired_ids:
+                    cursor.execute("""UPDATE pull_request
+                                      SET assignee_login=NULL, build_node=NULL, build_started=NULL
+                                      WHERE id = ANY(%(ids)s)
+                                      RETURNING id, url""", {'ids': expired_ids})
+                    expired = cursor.fetchall()
+            for (pr_id, pr_url) in expired:
+                outbox.unassign(cursor, pr_url)
+            conn.commit()
+        finally:
+            cursor.close()
+    for (pr_id, pr_url) in expired:
+        print('Build lease on PR %d expired, returned it to the queue' % pr_id)
+        invalidate_pr(pr_id)
+    return [pr_id for (pr_id, pr_url) in expired]
+
+def run_reaper():
+    while True:
+        try:
+            reap_expired_leases()
+        except (psycopg2.Error, Error) as err:
+            print('Could not reap expired build leases: %s' % err)
+        time.sleep(reap_interval)
+
+def json_response(body):
+    return Response(body, mimetype='application/json')
 
 @app.route('/automerge/api/v1.0/pr/', methods=['GET'])
 def get_prs():
-    conn = merger.get_connection()
+    return list_prs(NOT_CLOSED_PR_CONDITION)
+
+@app.route('/automerge/api/v1.0/pr/build_ready', methods=['GET'])
+def get_buildable_prs():
+    return list_prs(BUILDABLE_PR_CONDITION)
+
+def bad_request(message):
+    abort(make_response(jsonify({'result': message}), 400))
+
+def parse_list_arguments():
+    """
+    Read the paging and projection arguments of a list request: "after_id"
+    (return PRs with a greater ID), "limit" and "fields" (comma separated
+    names from PR_FIELD_NAMES). The ID is always returned, as callers need it
+    to request the next page.
+    """
     try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        bad_request('after_id and limit must be integers')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        bad_request('limit must be between 1 and %d' % MAX_PAGE_SIZE)
+    if 'fields' in request.args:
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        invalid = [field for field in fields if field not in PR_FIELD_NAMES]
+        if invalid:
+            bad_request('Invalid fields specified: ' + ', '.join(invalid))
+        if 'id' not in fields:
+            fields.insert(0, 'id')
+    else:
+        fields = PR_FIELD_NAMES
+    return (after_id, limit, fields)
+
+def list_prs(condition):
+    """
+    Return a page of the PRs matching the condition, in ID order, with a
+    "next_after_id" to fetch the following page from (null on the last page).
+
+    The ETag is the pull_request change counter, so a caller repeating a
+    request with If-None-Match gets a 304 without the table being read if
+    nothing has changed since. Pages are served from the response cache
+    where possible, without touching the database at all.
+    """
+    (after_id, limit, fields) = parse_list_arguments()
+    key = ('list', condition, after_id, limit, tuple(fields))
+    cached = response_cache.get(key)
+    if cached:
+        (body, etag) = cached
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = json_response(body)
+        response.set_etag(etag)
+        return response
+
+    generation = response_cache.generation
+    with db_pool.connection() as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         try:
-            cursor.execute("""SELECT id, number, url,state,title,user_login,html_url,assignee_login,milestone_title,base_ref, build_node, s3_arn, test_node
+            # Read before the PRs, so the data returned is never older than its ETag claims
+            cursor.execute("""SELECT version FROM pull_request_change WHERE id=1""")
+            etag = 'prs-%d' % cursor.fetchone()['version']
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            # Field names are checked against PR_FIELD_NAMES, so are safe to interpolate
+            cursor.execute("""SELECT %s
                               FROM pull_request
-                              WHERE project='dogecoin/dogecoin' and state!='closed'
-                              ORDER BY id ASC""")
-            return jsonify({'prs': cursor.fetchall()})
+                              WHERE %s AND id > %%(after_id)s
+                              ORDER BY id ASC
+                              LIMIT %%(limit)s""" % (', '.join(fields), condition),
+                           {'after_id': after_id, 'limit': limit})
+            prs = cursor.fetchall()
         finally:
             cursor.close()
-    finally:
-        conn.close()
+    next_after_id = prs[-1]['id'] if len(prs) == limit else None
+    response = jsonify({'prs': prs, 'next_after_id': next_after_id})
+    response.set_etag(etag)
+    response_cache.put(key, (response.get_data(), etag), generation)
+    return response
 
-@app.route('/automerge/api/v1.0/pr/build_ready', methods=['GET'])
-def get_buildable_prs():
-    conn = merger.get_connection()
-    try:
+@app.route('/automerge/api/v1.0/pr/claim_next', methods=['POST'])
+def claim_next_pr():
+    """
+    Claim the next buildable PR for the calling build node. If none is
+    available and the request has a "wait" value, the request is held open
+    for up to that many seconds (capped at MAX_CLAIM_WAIT) until a PR becomes
+    buildable, so idle nodes pick up new work as soon as it's ready.
+    """
+    username = 'rnicoll'
+    wait = 0
+    if request.json and 'wait' in request.json:
+        wait = min(max(float(request.json['wait']), 0), MAX_CLAIM_WAIT)
+    deadline = time.time() + wait
+    while True:
+        # Read the generation before trying, so a notification arriving
+        # between the attempt and the wait still wakes us
+        generation = listener.generation('build_ready')
+        pr = claim_next_buildable_pr(username, request.remote_addr)
+        remaining = deadline - time.time()
+        if pr or remaining <= 0:
+            break
+        listener.wait('build_ready', generation, remaining)
+    if not pr:
+        return jsonify({'result': 'No builds available'})
+    return jsonify({'result': 'ok', 'pr': pr, 'lease_duration': lease_duration})
+
+def claim_next_buildable_pr(username, remote_addr):
+    """
+    Claim the next buildable PR in a single transaction, returning it or
+    None. Concurrent callers skip over rows another claim has locked rather
+    than queueing behind it, so each gets a different PR.
+    """
+    with db_pool.connection() as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         try:
-            cursor.execute("""SELECT id, number, url,state,title,user_login,html_url,assignee_login,milestone_title,base_ref, build_node, s3_arn, test_node
-                              FROM pull_request
-                              WHERE project='dogecoin/dogecoin' and state='open' and assignee_login is null and milestone_title='1.9' and base_ref='1.9-dev' and build_node IS NULL
-                              ORDER BY id ASC""")
-            return jsonify({'prs': cursor.fetchall()})
+            cursor.execute("""UPDATE pull_request
+                              SET assignee_login=%%(username)s, build_node=%%(remote_addr)s, build_started=NOW()
+                              WHERE id=(
+                                  SELECT id
+                                  FROM pull_request
+                                  WHERE %s
+                                  ORDER BY id ASC
+                                  LIMIT 1
+                                  FOR UPDATE SKIP LOCKED)
+                              RETURNING %s""" % (BUILDABLE_PR_CONDITION, PR_FIELDS),
+                           {'username': username, 'remote_addr': remote_addr})
+            pr = cursor.fetchone()
+            if pr:
+                grant_lease(cursor, pr['id'])
+                # Tell Github we've claimed the PR, via the outbox so it happens if and only if the claim commits
+                outbox.assign(cursor, pr['url'], username)
+            conn.commit()
         finally:
             cursor.close()
-    finally:
-        conn.close()
+    if pr:
+        invalidate_pr(pr['id'])
+    return pr
+
+@app.route('/automerge/api/v1.0/stats', methods=['GET'])
+def get_stats():
+    return jsonify({'pool': db_pool.stats(), 'response_cache': response_cache.stats()})
 
 @app.route('/automerge/api/v1.0/pr/<int:pr_id>', methods=['GET'])
 def get_pr(pr_id):
-    conn = merger.get_connection()
-    try:
+    key = ('pr', pr_id)
+    body = response_cache.get(key)
+    if body:
+        return json_response(body)
+
+    generation = response_cache.generation
+    with db_pool.connection() as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         try:
             cursor.execute("""SELECT id, number, url,state,title,user_login,html_url,assignee_login,milestone_title,base_ref, build_node, s3_arn, test_node
                               FROM pull_request
                               WHERE id=%(id)s""", {'id': pr_id})
-            return jsonify({'prs': cursor.fetchall()})
+            response = jsonify({'prs': cursor.fetchall()})
         finally:
             cursor.close()
-    finally:
-        conn.close()
+    response_cache.put(key, response.get_data(), generation)
+    return response
 
 @app.route('/automerge/api/v1.0/pr/<int:pr_id>', methods=['POST'])
 def update_pr(pr_id):
+    response = apply_pr_operation(pr_id)
+    # Every other operation writes the PR, so drop cached copies once it has
+    # committed; heartbeats only touch build_lease, which no response includes
+    if not request.json or request.json.get('operation') != 'heartbeat':
+        invalidate_pr(pr_id)
+    return response
+
+def apply_pr_operation(pr_id):
     pr_url = None
-    conn = merger.get_connection()
-    try:
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute("""SELECT url
@@ -82,12 +328,14 @@ def update_pr(pr_id):
 
         if request.json['operation'] == 'claim_build':
             return claim_pr(conn, pr_id, pr_url, 'rnicoll', request.remote_addr)
+        elif request.json['operation'] == 'heartbeat':
+            return extend_lease(conn, pr_id, request.remote_addr)
         elif request.json['operation'] == 'build_success':
             if not 's3_arn' in request.json:
                 return jsonify({'result': 'No S3 ARN specified'})
-            return mark_build_success(conn, pr_id, request.json['s3_arn'])
+            return mark_build_success(conn, pr_id, request.json['s3_arn'], request.remote_addr)
         elif request.json['operation'] == 'build_failed':
-            return mark_build_failed(conn, pr_id)
+            return mark_build_failed(conn, pr_id, request.remote_addr)
         elif request.json['operation'] == 'test_pr':
             return test_pr(conn, pr_id, pr_url, request.remote_addr)
         elif request.json['operation'] == 'test_success':
@@ -96,16 +344,8 @@ def update_pr(pr_id):
             return mark_test_failed(conn, pr_id)
         else:
             return jsonify({'result': 'Invalid operation specified'})
-    finally:
-        conn.close()
 
 def claim_pr(conn, pr_id, pr_url, username, remote_addr):
-    # Tell Github we're claiming the PR
-    request = {
-        'assignee': username
-    }
-    if not merger.call_github(pr_url, request, 'PATCH'):
-        return jsonify({'result': 'failed to call Github'})
     # Update the local database
     cursor = conn.cursor()
     try:
@@ -114,36 +354,91 @@ def claim_pr(conn, pr_id, pr_url, username, remote_addr):
                           WHERE id=%(id)s AND build_node IS NULL""",
                        {'id': pr_id, 'username': username, 'remote_addr': remote_addr})
         rowcount = cursor.rowcount
+        if rowcount > 0:
+            grant_lease(cursor, pr_id)
+            # Tell Github we're claiming the PR, once the claim commits
+            outbox.assign(cursor, pr_url, username)
         conn.commit()
     finally:
         cursor.close()
     if rowcount > 0:
         # Return a value to let the node know that's okay
-        return jsonify({'result': 'ok'})
+        return jsonify({'result': 'ok', 'lease_duration': lease_duration})
     else:
         return jsonify({'result': 'Build already taken'})
 
-def mark_build_failed(conn, pr_id):
+def grant_lease(cursor, pr_id):
+    """ Start (or restart) the build lease on a PR just claimed, in the claim's transaction """
+    cursor.execute("""INSERT INTO build_lease (pr_id, expires)
+                      VALUES (%(id)s, NOW() + %(lease_duration)s * INTERVAL '1 second')
+                      ON CONFLICT (pr_id) DO UPDATE SET expires=EXCLUDED.expires""",
+                   {'id': pr_id, 'lease_duration': lease_duration})
+
+def release_lease(cursor, pr_id):
+    cursor.execute("""DELETE FROM build_lease WHERE pr_id=%(id)s""", {'id': pr_id})
+
+def extend_lease(conn, pr_id, remote_addr):
+    """
+    Extend the build lease held by the calling node, if it still holds it.
+    Only build_lease is written, so heartbeats don't count as changes to the
+    PR for ETags or cached responses.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""UPDATE build_lease
+                          SET expires=NOW() + %(lease_duration)s * INTERVAL '1 second'
+                          WHERE pr_id=%(id)s
+                              AND pr_id IN (SELECT id FROM pull_request WHERE id=%(id)s AND build_node=%(remote_addr)s)""",
+                       {'id': pr_id, 'remote_addr': remote_addr, 'lease_duration': lease_duration})
+        rowcount = cursor.rowcount
+        conn.commit()
+    finally:
+        cursor.close()
+    if rowcount > 0:
+        return jsonify({'result': 'ok', 'lease_duration': lease_duration})
+    else:
+        return jsonify({'result': 'Lease lost'})
+
+def mark_build_failed(conn, pr_id, remote_addr):
+    # Only the node holding the build claim may report on it; the claim may
+    # have been reaped and handed to another node since
+    cursor = conn.cursor()
     try:
         cursor.execute("""UPDATE pull_request
                           SET build_failed=NOW()
-                          WHERE id=%(id)s""", {'id': pr_id})
+                          WHERE id=%(id)s AND build_node=%(remote_addr)s""",
+                       {'id': pr_id, 'remote_addr': remote_addr})
+        rowcount = cursor.rowcount
+        if rowcount > 0:
+            release_lease(cursor, pr_id)
         conn.commit()
     finally:
         cursor.close()
-    # Return a value to let the node know that's okay
-    return jsonify({'result': 'ok'})
+    if rowcount > 0:
+        # Return a value to let the node know that's okay
+        return jsonify({'result': 'ok'})
+    else:
+        return jsonify({'result': 'Lease lost'})
 
-def mark_build_success(conn, pr_id, s3_arn):
+def mark_build_success(conn, pr_id, s3_arn, remote_addr):
+    # As mark_build_failed(), only the node holding the build claim may report on it
+    cursor = conn.cursor()
     try:
         cursor.execute("""UPDATE pull_request
                           SET build_succeeded=NOW(), s3_arn=%(s3_arn)s
-                          WHERE id=%(id)s""", {'id': pr_id, 's3_arn': s3_arn})
+                          WHERE id=%(id)s AND build_node=%(remote_addr)s""",
+                       {'id': pr_id, 's3_arn': s3_arn, 'remote_addr': remote_addr})
+        rowcount = cursor.rowcount
+        if rowcount > 0:
+            release_lease(cursor, pr_id)
         conn.commit()
     finally:
         cursor.close()
-    # Return a value to let the node know that's okay
-    return jsonify({'result': 'ok'})
+    if rowcount > 0:
+        # Return a value to let the node know that's okay
+        return jsonify({'result': 'ok'})
+    else:
+        return jsonify({'result': 'Lease lost'})
 
 def test_pr(conn, pr_id, pr_url, remote_addr):
     # Update the local database
@@ -159,6 +454,7 @@ def test_pr(conn, pr_id, pr_url, remote_addr):
     return jsonify({'result': 'ok'})
 
 def mark_test_failed(conn, pr_id):
+    cursor = conn.cursor()
     try:
         cursor.execute("""UPDATE pull_request
                           SET test_failed=NOW()
@@ -170,9 +466,10 @@ def mark_test_failed(conn, pr_id):
     return jsonify({'result': 'ok'})
 
 def mark_test_success(conn, pr_id):
+    cursor = conn.cursor()
     try:
         cursor.execute("""UPDATE pull_request
-                          SET test_succeeded=NOW()s
+                          SET test_succeeded=NOW()
                           WHERE id=%(id)s""", {'id': pr_id})
         conn.commit()
     finally:
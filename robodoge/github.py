@@ -0,0 +1,337 @@
+from collections import deque
+from io import BytesIO
+import hashlib
+import json
+import os
+import os.path
+import pycurl
+import threading
+import time
+
+from . import Error
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 5
+
+class GitHubError(Error):
+    """ Error returned by, or while talking to, the GitHub API """
+    def __init__(self, msg, status_code=None):
+        self.msg = msg
+        self.status_code = status_code
+    def __str__(self):
+        return repr(self.msg)
+
+class ResponseCache:
+    """
+    On-disk cache of GitHub API responses, keyed by URL.
+
+    Each entry stores the ETag/Last-Modified validators alongside the response
+    body, so that unchanged resources can be revalidated with a conditional
+    request and served locally when GitHub answers 304. Entries are evicted
+    least recently used first once the cache grows past max_size bytes.
+    """
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.path) if entry.name.endswith('.json')]
+
+    def _entry_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('UTF-8')).hexdigest() + '.json')
+
+    def get(self, url):
+        """ Return the cached entry for the given URL, or None if there isn't one """
+        entry_path = self._entry_path(url)
+        try:
+            with open(entry_path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        # Touch the entry so eviction treats it as recently used
+        os.utime(entry_path)
+        return entry
+
+    def put(self, url, etag, last_modified, body):
+        """ Store a response body along with the validators GitHub returned for it """
+        entry_path = self._entry_path(url)
+        try:
+            old_size = os.path.getsize(entry_path)
+        except OSError:
+            old_size = 0
+        tmp_path = entry_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'body': body}, f)
+        os.replace(tmp_path, entry_path)
+        self.size += os.path.getsize(entry_path) - old_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until the cache is back under 90% of its size limit """
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        target = self.max_size * 0.9
+        for entry in entries:
+            if self.size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size -= size
+
+class RateLimiter:
+    """
+    Token bucket tracking the request budget GitHub reports back to us.
+
+    The bucket holds the X-RateLimit-Remaining count from the most recent
+    response, less any requests made since, and is refilled at
+    X-RateLimit-Reset. Requests run at full speed while tokens remain; only
+    once the bucket is empty, or GitHub has asked us to back off with
+    Retry-After, does acquire() pause, and then only until the budget resets.
+    """
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.remaining = None
+        self.reset_at = None
+        self.retry_at = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until the budget allows another request, then consume a token for it """
+        # Held while pausing, so concurrent callers all wait out the same pause
+        with self.lock:
+            self._acquire()
+
+    def _acquire(self):
+        now = self.clock()
+        if self.retry_at and now < self.retry_at:
+            print('GitHub asked us to retry later, pausing for %d seconds' % (self.retry_at - now))
+            self.sleep(self.retry_at - now)
+            now = self.clock()
+        if self.remaining is not None and self.remaining <= 0 and self.reset_at and now < self.reset_at:
+            # Reset time is in whole seconds; allow one extra to avoid racing it
+            print('GitHub rate limit exhausted, pausing for %d seconds until it resets' % (self.reset_at - now + 1))
+            self.sleep(self.reset_at - now + 1)
+            self.remaining = None
+        if self.remaining is not None:
+            self.remaining -= 1
+
+    def update(self, headers):
+        """ Update the bucket from the headers of a GitHub API response """
+        with self.lock:
+            self._update(headers)
+
+    def _update(self, headers):
+        now = self.clock()
+        if 'x-ratelimit-reset' in headers:
+            self.reset_at = int(headers['x-ratelimit-reset'])
+        if 'x-ratelimit-remaining' in headers:
+            self.remaining = int(headers['x-ratelimit-remaining'])
+        if 'retry-after' in headers:
+            self.retry_at = now + int(headers['retry-after'])
+        elif self.retry_at and self.retry_at <= now:
+            self.retry_at = None
+
+    def is_rate_limited(self, status_code, headers):
+        """ Test whether a response is GitHub refusing a request due to rate limiting """
+        if status_code not in (403, 429):
+            return False
+        return 'retry-after' in headers or headers.get('x-ratelimit-remaining') == '0'
+
+class GitHubClient:
+    """
+    Client for the GitHub API.
+
+    Where a response cache is provided, GET requests are made conditional on
+    the cached ETag/Last-Modified and 304 responses are served from the cache;
+    GitHub does not count these against the rate limit. All requests pass
+    through a RateLimiter, and requests refused for rate limiting are retried
+    once the limiter allows.
+
+    Curl handles are kept between requests so connections to GitHub are
+    reused rather than re-established for every call.
+    """
+    def __init__(self, private_token, cache=None, concurrency=DEFAULT_CONCURRENCY, rate_limiter=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.private_token = private_token
+        self.cache = cache
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.curl = pycurl.Curl()
+        self.multi = pycurl.CurlMulti()
+        self.handles = [pycurl.Curl() for i in range(max(1, concurrency))]
+
+    def _prepare(self, c, url, request=None, method=None):
+        """
+        Set up a curl handle to call the given URL. Requests with no body are
+        GETs, made conditional if we have the URL cached.
+        """
+        c.reset()
+        c.url = url
+        c.entry = None
+        c.buffer = BytesIO()
+        c.response_headers = {}
+        headers = []
+        if request is None and self.cache:
+            c.entry = self.cache.get(url)
+            if c.entry:
+                if c.entry['etag']:
+                    headers.append('If-None-Match: ' + c.entry['etag'])
+                if c.entry['last_modified']:
+                    headers.append('If-Modified-Since: ' + c.entry['last_modified'])
+
+        response_headers = c.response_headers
+        c.setopt(c.URL, url)
+        c.setopt(c.USERNAME, self.private_token)
+        c.setopt(c.PASSWORD, 'x-oauth-basic')
+        c.setopt(c.WRITEDATA, c.buffer)
+        c.setopt(c.HEADERFUNCTION, lambda line: parse_header_line(line, response_headers))
+        if request is not None:
+            headers.append('Content-Type: application/json; charset=utf-8')
+            c.setopt(c.POSTFIELDS, json.dumps(request))
+            if method:
+                c.setopt(c.CUSTOMREQUEST, method)
+            else:
+                c.setopt(c.POST, 1)
+        c.setopt(c.HTTPHEADER, headers)
+
+    def _rate_limited(self, c):
+        """ Record rate limit headers from a completed request, returning true if it should be retried """
+        self.rate_limiter.update(c.response_headers)
+        return self.rate_limiter.is_rate_limited(c.getinfo(c.RESPONSE_CODE), c.response_headers)
+
+    def _finish(self, c):
+        """ Decode the response to a completed GET request, updating the cache as needed """
+        status_code = c.getinfo(c.RESPONSE_CODE)
+        if status_code == 304 and c.entry:
+            return json.loads(c.entry['body'])
+        if status_code != 200:
+            raise GitHubError('Received %d response from %s, expected 200' % (status_code, c.url), status_code)
+
+        body = c.buffer.getvalue().decode('UTF-8')
+        if self.cache and ('etag' in c.response_headers or 'last-modified' in c.response_headers):
+            self.cache.put(c.url, c.response_headers.get('etag'), c.response_headers.get('last-modified'), body)
+        return json.loads(body)
+
+    def _perform(self, url, request=None, method=None):
+        """ Perform a single request on the persistent handle, retrying if rate limited """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            self._prepare(self.curl, url, request, method)
+            try:
+                self.curl.perform()
+            except pycurl.error as err:
+                raise GitHubError('Error fetching %s: %s' % (url, err.args[1]))
+            if not self._rate_limited(self.curl):
+                return self.curl
+        raise GitHubError('Still rate limited by GitHub after %d retries of %s' % (self.max_retries, url),
+            self.curl.getinfo(self.curl.RESPONSE_CODE))
+
+    def call(self, url, request, method=None):
+        """ Send a JSON request to the GitHub API (POST unless another method is given) and return the decoded response """
+        c = self._perform(url, request, method)
+        status_code = c.getinfo(c.RESPONSE_CODE)
+        if status_code < 200 or status_code > 299:
+            raise GitHubError("Returned status from GitHub API was %d, expected 200-range status code" % status_code, status_code)
+        body = c.buffer.getvalue().decode('UTF-8')
+        if not body:
+            # e.g. 204 No Content
+            return None
+        return json.loads(body)
+
+    def get_json(self, url):
+        """ Fetch a URL from the GitHub API and return the decoded JSON body """
+        return self._finish(self._perform(url))
+
+    def get_json_many(self, urls):
+        """
+        Fetch several URLs from the GitHub API concurrently, with at most as
+        many requests in flight as the client was configured for. Yields
+        (url, decoded JSON body) tuples as each request completes, so callers
+        can process results while the remaining requests are still running.
+        """
+        pending = deque(urls)
+        attempts = {}
+        free = list(self.handles)
+        active = []
+        try:
+            while pending or active:
+                while pending and free:
+                    self.rate_limiter.acquire()
+                    c = free.pop()
+                    self._prepare(c, pending.popleft())
+                    self.multi.add_handle(c)
+                    active.append(c)
+
+                ret = pycurl.E_CALL_MULTI_PERFORM
+                try:
+                    while ret == pycurl.E_CALL_MULTI_PERFORM:
+                        (ret, num_handles) = self.multi.perform()
+                except pycurl.error as err:
+                    raise GitHubError('Error fetching from GitHub: %s' % err.args[1])
+
+                completed = []
+                num_queued = 1
+                while num_queued:
+                    (num_queued, ok_list, err_list) = self.multi.info_read()
+                    for (c, errno, errmsg) in err_list:
+                        raise GitHubError('Error fetching %s: %s' % (c.url, errmsg))
+                    completed.extend(ok_list)
+
+                for c in completed:
+                    self.multi.remove_handle(c)
+                    active.remove(c)
+                    if self._rate_limited(c):
+                        attempts[c.url] = attempts.get(c.url, 0) + 1
+                        if attempts[c.url] > self.max_retries:
+                            raise GitHubError('Still rate limited by GitHub after %d retries of %s' % (self.max_retries, c.url),
+                                c.getinfo(c.RESPONSE_CODE))
+                        # Requeue; the limiter will hold off until GitHub allows it
+                        pending.append(c.url)
+                        free.append(c)
+                        continue
+                    data = self._finish(c)
+                    free.append(c)
+                    yield (c.url, data)
+
+                if active:
+                    try:
+                        self.multi.select(1.0)
+                    except pycurl.error as err:
+                        raise GitHubError('Error fetching from GitHub: %s' % err.args[1])
+        finally:
+            for c in active:
+                self.multi.remove_handle(c)
+
+def parse_header_line(line, headers):
+    """ pycurl HEADERFUNCTION callback, collecting headers into a dict keyed by lower-case name """
+    line = line.decode('iso-8859-1')
+    if ':' not in line:
+        # Status line or the blank line ending the headers. Redirects and
+        # "100 Continue" produce more than one block of headers, so only the
+        # last block should survive.
+        if line.startswith('HTTP/'):
+            headers.clear()
+        return
+    name, value = line.split(':', 1)
+    headers[name.strip().lower()] = value.strip()
+
+def build_client(github_config):
+    """ Build a GitHub client as described by the "github" configuration section """
+    return GitHubClient(github_config['private_token'], build_cache(github_config),
+        github_config.get('concurrency', DEFAULT_CONCURRENCY))
+
+def build_cache(github_config):
+    """ Build the response cache described by the "github" configuration section, if any """
+    if 'cache_path' not in github_config:
+        return None
+    return ResponseCache(github_config['cache_path'], github_config.get('cache_size', DEFAULT_CACHE_SIZE))
@@ -0,0 +1,227 @@
+import queue
+import threading
+import time
+
+from . import *
+from . import conflicts
+
+# Pages held between pipeline stages. Keeps memory bounded while still
+# letting network fetches run ahead of the database writer.
+DEFAULT_QUEUE_SIZE = 4
+
+class _Done:
+    """ Marker passed down the pipeline once a stage has no more output """
+    pass
+
+class _Failed:
+    """ Marker passed down the pipeline when a stage raises an exception """
+    def __init__(self, err):
+        self.err = err
+
+class StageStats:
+    """ Running totals for one stage of the import pipeline """
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.count = 0
+        self.seconds = 0.0
+
+    def record(self, count, started):
+        self.count += count
+        self.seconds += time.time() - started
+
+    def __str__(self):
+        rate = self.count / self.seconds if self.seconds > 0 else 0.0
+        return '%s: %d %s in %.1fs busy (%.1f %s/sec)' % (self.name, self.count, self.unit, self.seconds, rate, self.unit)
+
+class Page:
+    """ A page of pull requests passing through the import pipeline """
+    def __init__(self, number, prs):
+        self.number = number
+        self.prs = prs
+        self.new_pr_commits = {}
+        self.pr_rows = []
+        self.commit_rows = []
+
+class Importer:
+    """
+    Imports pull requests for a GitHub project into the database.
+
+    Work is structured as a pipeline of stages connected by bounded queues,
+    each stage running in its own thread so that fetching pull request pages,
+    fetching commit lists, parsing and database writes all overlap:
+
+        fetch pages -> fetch commits -> parse -> write
+
+    By default the import is incremental: pull requests are read most
+    recently updated first, and fetching stops once it reaches data imported
+    by a previous run.
+    """
+    def __init__(self, merger, project, state=None, update=True, batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE):
+        self.merger = merger
+        self.project = project
+        self.state = state
+        self.update = update
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.newest_updated_at = None
+        self.stats = [
+            StageStats('fetch pages', 'PRs'),
+            StageStats('fetch commits', 'commit lists'),
+            StageStats('parse', 'PRs'),
+            StageStats('write', 'rows'),
+        ]
+
+    def pulls_url(self, page):
+        url = 'https://api.github.com/repos/%s/pulls?sort=updated&direction=desc&page=%d' % (self.project, page)
+        if self.state:
+            url += '&state=' + self.state
+        return url
+
+    def fetch_pages(self, since):
+        """ Generator over pages of pull requests, stopping at those updated before "since" """
+        stats = self.stats[0]
+        page_number = 1
+        while True:
+            started = time.time()
+            url = self.pulls_url(page_number)
+            response = self.merger.github.get_json(url)
+            print('Fetched %d pull requests from %s' % (len(response), url))
+            if len(response) == 0:
+                # No more data
+                return
+
+            prs = []
+            more = True
+            for pr in response:
+                updated_at = parse_github_timestamp(pr['updated_at'])
+                if since and updated_at < since:
+                    print('Reached pull requests imported by a previous run, stopping')
+                    more = False
+                    break
+                if not self.newest_updated_at or updated_at > self.newest_updated_at:
+                    self.newest_updated_at = updated_at
+                prs.append(pr)
+            stats.record(len(prs), started)
+
+            if prs:
+                yield Page(page_number, prs)
+            if not more:
+                return
+            page_number += 1
+
+    def fetch_commits(self, pages, conn):
+        """ Fetch the commit lists of pull requests not yet in the database, in parallel """
+        stats = self.stats[1]
+        for page in pages:
+            started = time.time()
+            cursor = conn.cursor()
+            try:
+                existing_pr_ids = get_existing_pr_ids(cursor, [pr['id'] for pr in page.prs])
+            finally:
+                cursor.close()
+            # Read-only, so don't leave the connection idle in a transaction
+            conn.rollback()
+
+            new_pr_ids = dict((pr['commits_url'], pr['id']) for pr in page.prs if pr['id'] not in existing_pr_ids)
+            for (commits_url, commits) in self.merger.github.get_json_many(new_pr_ids.keys()):
+                page.new_pr_commits[new_pr_ids[commits_url]] = commits
+            stats.record(len(new_pr_ids), started)
+            yield page
+
+    def parse(self, pages):
+        """ Convert pull requests and commits from the GitHub API into database rows """
+        stats = self.stats[2]
+        for page in pages:
+            started = time.time()
+            page.pr_rows = [extract_pr_data(pr, self.project) for pr in page.prs]
+            for (pr_id, commits) in page.new_pr_commits.items():
+                page.commit_rows.extend((pr_id, ordinality, commit['sha']) for (ordinality, commit) in enumerate(commits, 1))
+            stats.record(len(page.prs), started)
+            yield page
+
+    def write(self, pages, conn):
+        """ Write each page, and the commits of its new pull requests, as one transaction """
+        stats = self.stats[3]
+        for page in pages:
+            started = time.time()
+            cursor = conn.cursor()
+            try:
+                write_pr_rows(cursor, page.pr_rows, self.update, self.batch_size)
+                write_commits(cursor, page.commit_rows, self.batch_size)
+                conn.commit()
+            finally:
+                cursor.close()
+            stats.record(len(page.pr_rows) + len(page.commit_rows), started)
+
+    def run(self, full=False):
+        """
+        Run the import, walking every page if "full" is true, or only pull
+        requests updated since the previous run otherwise.
+        """
+        started = time.time()
+        write_conn = self.merger.get_connection()
+        read_conn = self.merger.get_connection()
+        try:
+            cursor = write_conn.cursor()
+            try:
+                since = None if full else get_import_high_water_mark(cursor, self.project)
+            finally:
+                cursor.close()
+
+            pages = self.fetch_pages(since)
+            pages = _threaded(pages, self.queue_size)
+            pages = _threaded(self.fetch_commits(pages, read_conn), self.queue_size)
+            pages = _threaded(self.parse(pages), self.queue_size)
+            self.write(pages, write_conn)
+
+            if self.newest_updated_at and (not since or self.newest_updated_at > since):
+                cursor = write_conn.cursor()
+                try:
+                    set_import_high_water_mark(cursor, self.project, self.newest_updated_at)
+                    write_conn.commit()
+                finally:
+                    cursor.close()
+
+            # Index the files touched by the new commits, where we have them locally
+            indexed = conflicts.update_conflict_index(write_conn, self.merger.repo)
+            if indexed:
+                print('Indexed paths touched by %d commits' % indexed)
+        finally:
+            read_conn.close()
+            write_conn.close()
+
+        print('Imported %s in %.1fs' % (self.project, time.time() - started))
+        for stats in self.stats:
+            print('  ' + str(stats))
+
+def _threaded(source, queue_size):
+    """
+    Run a generator in its own thread, returning a generator over its output
+    via a bounded queue. Exceptions raised in the thread are re-raised in the
+    consumer.
+    """
+    buffer = queue.Queue(queue_size)
+
+    def produce():
+        try:
+            for item in source:
+                buffer.put(item)
+            buffer.put(_Done())
+        except Exception as err:
+            buffer.put(_Failed(err))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = buffer.get()
+        if isinstance(item, _Done):
+            break
+        if isinstance(item, _Failed):
+            raise item.err
+        yield item
+    thread.join()
+
+def run_import(merger, project, state=None, update=True, full=False, batch_size=DEFAULT_BATCH_SIZE):
+    """ Import pull requests for a project, see Importer """
+    Importer(merger, project, state, update, batch_size).run(full)
@@ -0,0 +1,95 @@
+import psycopg2
+import psycopg2.extensions
+import select
+import threading
+import time
+
+DEFAULT_RECONNECT_DELAY = 5
+
+class NotificationListener:
+    """
+    Background thread holding one PostgreSQL connection which LISTENs on a
+    set of channels, so any number of request threads can wait for a
+    notification without each tying up a connection.
+
+    Each channel has a generation counter, bumped on every notification.
+    Waiters read the generation before checking for work, then wait for it
+    to change, so a notification arriving between the check and the wait is
+    never missed.
+    """
+    def __init__(self, dsn, channels, reconnect_delay=DEFAULT_RECONNECT_DELAY):
+        self.dsn = dsn
+        self.channels = list(channels)
+        self.reconnect_delay = reconnect_delay
+        self.condition = threading.Condition()
+        self.generations = dict((channel, 0) for channel in self.channels)
+        self.callbacks = dict((channel, []) for channel in self.channels)
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        """ Start the listener thread, if it isn't already running """
+        with self.start_lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def add_callback(self, channel, callback):
+        """ Call "callback(payload)" from the listener thread on each notification on the channel """
+        self.callbacks[channel].append(callback)
+
+    def generation(self, channel):
+        with self.condition:
+            return self.generations[channel]
+
+    def wait(self, channel, generation, timeout):
+        """
+        Wait up to "timeout" seconds for a notification on the channel after
+        the given generation. Returns true if one arrived.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.generations[channel] == generation:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def _notified(self, channel, payload):
+        with self.condition:
+            self.generations[channel] += 1
+            self.condition.notify_all()
+        for callback in self.callbacks.get(channel, []):
+            callback(payload)
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error as err:
+                print('Notification listener lost its connection: %s' % err)
+            # Anything may have changed while we weren't listening
+            for channel in self.channels:
+                self._notified(channel, None)
+            time.sleep(self.reconnect_delay)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = conn.cursor()
+            try:
+                for channel in self.channels:
+                    cursor.execute('LISTEN "%s"' % channel)
+            finally:
+                cursor.close()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self._notified(notify.channel, notify.payload)
+        finally:
+            conn.close()
@@ -0,0 +1,160 @@
+import json
+import os
+import os.path
+import re
+
+from . import Error
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db', 'migrations')
+
+# Migration files are named <version>_<description>.sql, e.g. 002_query_indexes.sql
+MIGRATION_FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+# Hot queries, and the index each is expected to use. Parameters are
+# representative values; check_query_plans() only EXPLAINs them.
+HOT_QUERIES = [
+    ('get_prs',
+     """SELECT id FROM pull_request
+        WHERE project='dogecoin/dogecoin' and state!='closed' AND id > %(after_id)s
+        ORDER BY id ASC
+        LIMIT %(limit)s""",
+     {'after_id': 0, 'limit': 100},
+     'pull_request_not_closed_idx'),
+    ('get_buildable_prs',
+     """SELECT id FROM pull_request
+        WHERE project='dogecoin/dogecoin' and state='open' and assignee_login is null and milestone_title='1.9' and base_ref='1.9-dev' and build_node IS NULL AND id > %(after_id)s
+        ORDER BY id ASC
+        LIMIT %(limit)s""",
+     {'after_id': 0, 'limit': 100},
+     'pull_request_buildable_idx'),
+    ('get_commit_oids',
+     """SELECT commit.sha
+        FROM pull_request pr
+            JOIN pull_request_commit commit ON commit.pr_id=pr.id
+        WHERE pr.id=%(pr_id)s
+            AND commit.to_merge='t'
+            AND commit.merged='f'
+        ORDER BY commit.ordinality ASC""",
+     {'pr_id': 1},
+     'pull_request_commit_pending_idx'),
+    ('mass_test_candidates',
+     """SELECT pr.id, pr.title
+        FROM pull_request pr
+            JOIN pull_request_commit commit ON commit.pr_id=pr.id
+            LEFT JOIN pull_request_test_failure failure ON failure.pr_id=pr.id
+        WHERE commit.to_merge='t' AND commit.merged='f'
+            AND (failure.base_oid IS NULL OR failure.base_oid<>%(base_oid)s)
+        ORDER BY pr.merged_at, pr.id ASC""",
+     {'base_oid': '0' * 40},
+     'pull_request_commit_pending_idx'),
+    ('mark_commits',
+     """UPDATE pull_request_commit SET merged='t' WHERE sha=%(commit_id)s""",
+     {'commit_id': '0' * 40},
+     'pull_request_commit_sha_idx'),
+    ('reap_expired_leases',
+     """SELECT pr_id FROM build_lease
+        WHERE expires < NOW()""",
+     {},
+     'build_lease_expires_idx'),
+]
+
+class MigrationError(Error):
+    """ Error applying schema migrations """
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def list_migrations(path=MIGRATIONS_PATH):
+    """ Return (version, name, filename) for each migration in the directory, in version order """
+    migrations = []
+    for filename in os.listdir(path):
+        match = MIGRATION_FILENAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(path, filename)))
+    migrations.sort()
+    versions = [version for (version, name, filename) in migrations]
+    if len(set(versions)) != len(versions):
+        raise MigrationError('Duplicate migration versions in %s' % path)
+    return migrations
+
+def get_schema_version(conn):
+    """ Return the version of the last migration applied to the database, or 0 """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migration (
+                              version INTEGER NOT NULL,
+                              name VARCHAR(80) NOT NULL,
+                              applied_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                              PRIMARY KEY(version)
+                          )""")
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migration")
+        version = cursor.fetchone()[0]
+        conn.commit()
+    finally:
+        cursor.close()
+    return version
+
+def migrate(conn, path=MIGRATIONS_PATH):
+    """
+    Apply every migration newer than the database's schema version, each in
+    its own transaction. Returns the list of migrations applied.
+    """
+    current_version = get_schema_version(conn)
+    applied = []
+    for (version, name, filename) in list_migrations(path):
+        if version <= current_version:
+            continue
+        print('Applying migration %d (%s)' % (version, name))
+        with open(filename, 'r') as f:
+            sql = f.read()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migration (version, name) VALUES (%(version)s, %(name)s)",
+                {'version': version, 'name': name})
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        applied.append((version, name))
+    return applied
+
+def _plan_indexes(plan):
+    """ Collect the names of all indexes used anywhere in an EXPLAIN (FORMAT JSON) plan """
+    indexes = set()
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        indexes |= _plan_indexes(child)
+    return indexes
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """
+    EXPLAIN each hot query and check it can use the index intended for it.
+    Sequential scans are disabled for the check, so the result doesn't
+    depend on how much data the database holds; a query that still does not
+    use its index has drifted from the index definition.
+
+    Returns a list of (query name, expected index, indexes used) for each
+    query which failed the check; an empty list means all is well.
+    """
+    failures = []
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        for (name, sql, params, expected_index) in queries:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            indexes = _plan_indexes(plan[0]['Plan'])
+            if expected_index not in indexes:
+                failures.append((name, expected_index, sorted(indexes)))
+    finally:
+        cursor.close()
+        # Discards the SET LOCAL; EXPLAIN without ANALYZE never runs the queries themselves
+        conn.rollback()
+    return failures
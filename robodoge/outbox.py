@@ -0,0 +1,197 @@
+import json
+import time
+
+from . import Error
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 30
+DEFAULT_MAX_DELAY = 60 * 60
+DEFAULT_POLL_INTERVAL = 5
+# How long a worker holds a batch before other workers may take it, in case
+# it died part way. Longer than GitHub's hourly rate limit window, which a
+# worker may have to wait out while holding the batch.
+DEFAULT_CLAIM_TIMEOUT = 2 * 60 * 60
+
+def enqueue(cursor, url, request, method='POST'):
+    """
+    Record a GitHub API call to be made by the outbox worker. Doesn't commit,
+    so the call is only made if the caller's transaction commits.
+    """
+    cursor.execute("""INSERT INTO github_outbox (url, method, request)
+                      VALUES (%(url)s, %(method)s, %(request)s)""",
+                   {'url': url, 'method': method, 'request': json.dumps(request)})
+
+def issue_url(pr_url):
+    """ Convert a pull request API URL to the URL of the issue behind it """
+    return pr_url.replace('pulls', 'issues')
+
+def assign(cursor, pr_url, username):
+    """ Queue assigning a pull request to a user """
+    enqueue(cursor, issue_url(pr_url), {'assignee': username}, 'PATCH')
+
+def unassign(cursor, pr_url):
+    """ Queue removing the assignee from a pull request """
+    enqueue(cursor, issue_url(pr_url), {'assignee': None}, 'PATCH')
+
+def comment(cursor, pr_url, body):
+    """ Queue a comment on a pull request """
+    enqueue(cursor, issue_url(pr_url) + '/comments', {'body': body}, 'POST')
+
+def add_labels(cursor, pr_url, labels):
+    """ Queue adding labels to a pull request """
+    enqueue(cursor, issue_url(pr_url) + '/labels', labels, 'POST')
+
+class OutboxWorker:
+    """
+    Drains the GitHub outbox.
+
+    Pending calls are claimed in batches, selected with SKIP LOCKED so several
+    workers can run at once, and hidden from other workers for "claim_timeout"
+    seconds. The claim is committed before any call is made, so no locks or
+    transaction are held while talking to GitHub, and the outcome of each
+    call is committed as soon as it's known, so a crash part way through a
+    batch never causes completed calls to be repeated.
+
+    Calls to the same URL are always made in the order they were queued: a
+    call is only claimed once every earlier call to its URL has completed or
+    been given up on, so for example a retried assignment can never land
+    after a later unassignment. Consecutive PATCHes to the same URL within a
+    batch are coalesced into a single call, the later fields winning. Failed
+    calls are retried with exponential backoff, up to "max_attempts" times.
+    """
+    def __init__(self, merger, conn, batch_size=DEFAULT_BATCH_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+            base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+        self.merger = merger
+        self.conn = conn
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.claim_timeout = claim_timeout
+
+    def coalesce(self, rows):
+        """ Group outbox rows into calls, as lists of (ids, url, method, request) """
+        calls = []
+        for (row_id, url, method, request, attempts) in rows:
+            request = json.loads(request)
+            previous = calls[-1] if calls else None
+            if method == 'PATCH' and previous and previous[1] == url and previous[2] == 'PATCH':
+                previous[0].append((row_id, attempts))
+                previous[3].update(request)
+            else:
+                calls.append(([(row_id, attempts)], url, method, request))
+        return calls
+
+    def claim_batch(self):
+        """ Claim up to a batch of pending calls for this worker, returning the outbox rows """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("""SELECT id, url, method, request, attempts
+                              FROM github_outbox
+                              WHERE completed_at IS NULL AND next_attempt_at <= NOW() AND attempts < %(max_attempts)s
+                              ORDER BY id ASC
+                              LIMIT %(batch_size)s
+                              FOR UPDATE SKIP LOCKED""",
+                           {'max_attempts': self.max_attempts, 'batch_size': self.batch_size})
+            rows = self.in_order(cursor, cursor.fetchall())
+            if rows:
+                cursor.execute("""UPDATE github_outbox
+                                  SET next_attempt_at=NOW() + %(claim_timeout)s * INTERVAL '1 second'
+                                  WHERE id = ANY(%(ids)s)""",
+                               {'ids': [row[0] for row in rows], 'claim_timeout': self.claim_timeout})
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return rows
+
+    def in_order(self, cursor, rows):
+        """
+        Filter candidate rows down to those which may be sent now: for each
+        URL, only the leading run of its pending calls. Rows after a pending
+        call which isn't among the candidates (waiting out a backoff, or
+        claimed by another worker) must wait for it.
+        """
+        if not rows:
+            return rows
+        candidate_ids = set(row[0] for row in rows)
+        cursor.execute("""SELECT url, id
+                          FROM github_outbox
+                          WHERE url = ANY(%(urls)s) AND completed_at IS NULL AND attempts < %(max_attempts)s
+                          ORDER BY id ASC""",
+                       {'urls': list(set(row[1] for row in rows)), 'max_attempts': self.max_attempts})
+        sendable_ids = set()
+        blocked_urls = set()
+        for (url, row_id) in cursor.fetchall():
+            if url in blocked_urls:
+                continue
+            if row_id in candidate_ids:
+                sendable_ids.add(row_id)
+            else:
+                blocked_urls.add(url)
+        return [row for row in rows if row[0] in sendable_ids]
+
+    def release(self, entries):
+        """ Hand back claimed calls which weren't attempted, without counting an attempt """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("""UPDATE github_outbox
+                              SET next_attempt_at=NOW()
+                              WHERE id = ANY(%(ids)s)""", {'ids': [row_id for (row_id, attempts) in entries]})
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def record_outcome(self, entries, err=None):
+        """ Record the outcome of one call, made for the given (row ID, attempts) entries, and commit it """
+        cursor = self.conn.cursor()
+        try:
+            if err is None:
+                cursor.execute("""UPDATE github_outbox
+                                  SET attempts=attempts + 1, completed_at=NOW()
+                                  WHERE id = ANY(%(ids)s)""", {'ids': [row_id for (row_id, attempts) in entries]})
+            else:
+                for (row_id, attempts) in entries:
+                    delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+                    cursor.execute("""UPDATE github_outbox
+                                      SET attempts=attempts + 1, last_error=%(error)s,
+                                          next_attempt_at=NOW() + %(delay)s * INTERVAL '1 second'
+                                      WHERE id=%(id)s""",
+                                   {'id': row_id, 'error': str(err), 'delay': delay})
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def drain_once(self):
+        """ Send one batch of pending calls. Returns the number of outbox rows processed """
+        rows = self.claim_batch()
+        failed_urls = set()
+        for (entries, url, method, request) in self.coalesce(rows):
+            if url in failed_urls:
+                # Must wait for the earlier call to this URL to be retried
+                self.release(entries)
+                continue
+            try:
+                self.merger.call_github(url, request, method)
+            except Error as err:
+                print('GitHub call %s %s failed: %s' % (method, url, err))
+                self.record_outcome(entries, err)
+                failed_urls.add(url)
+                continue
+            self.record_outcome(entries)
+        return len(rows)
+
+    def run(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        """ Drain the outbox forever, pausing only when it is empty """
+        while True:
+            if self.drain_once() == 0:
+                time.sleep(poll_interval)
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import threading
+import time
+
+from . import Error
+
+DEFAULT_MIN_CONNECTIONS = 1
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_CHECKOUT_TIMEOUT = 30
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+
+class PoolExhaustedError(Error):
+    """ No pooled database connection became free within the checkout timeout """
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class ConnectionPool:
+    """
+    Thread-safe pool of PostgreSQL connections, wrapping psycopg2's
+    ThreadedConnectionPool.
+
+    Callers wait (up to "checkout_timeout" seconds) for a free connection
+    rather than failing as soon as the pool is exhausted. Connections which
+    have sat idle for longer than "health_check_interval" seconds are checked
+    with a trivial query on checkout, and replaced if they have gone bad.
+    Connections are rolled back on return, so no transaction leaks between
+    requests.
+    """
+    def __init__(self, dsn, minconn=DEFAULT_MIN_CONNECTIONS, maxconn=DEFAULT_MAX_CONNECTIONS,
+            checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.last_used = {}
+        self.counters = {
+            'checkouts': 0,
+            'in_use': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'health_checks': 0,
+            'replaced': 0,
+        }
+
+    def _count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    @contextmanager
+    def connection(self):
+        """ Context manager checking a connection out of the pool for the duration of the block """
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def checkout(self):
+        if not self.available.acquire(blocking=False):
+            self._count('waits')
+            if not self.available.acquire(timeout=self.checkout_timeout):
+                self._count('timeouts')
+                raise PoolExhaustedError('No database connection available after %d seconds' % self.checkout_timeout)
+        try:
+            conn = self.pool.getconn()
+            if not self._healthy(conn):
+                self._count('replaced')
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        except:
+            self.available.release()
+            raise
+        self._count('checkouts')
+        self._count('in_use')
+        return conn
+
+    def checkin(self, conn):
+        try:
+            if conn.closed:
+                self.pool.putconn(conn, close=True)
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self.last_used[id(conn)] = time.time()
+            self.pool.putconn(conn)
+        except psycopg2.Error:
+            self.pool.putconn(conn, close=True)
+        finally:
+            self._count('in_use', -1)
+            self.available.release()
+
+    def _healthy(self, conn):
+        """ Test a connection is usable, if it has been idle long enough to be worth checking """
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn))
+        if last_used and time.time() - last_used < self.health_check_interval:
+            return True
+        self._count('health_checks')
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def stats(self):
+        """ Return a snapshot of pool usage counters """
+        with self.lock:
+            stats = dict(self.counters)
+        stats['max'] = self.maxconn
+        return stats
+
+    def close(self):
+        self.pool.closeall()
@@ -0,0 +1,77 @@
+import os
+import time
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_BATCH_SIZE = 4
+DEFAULT_POLL_INTERVAL = 5 * 60
+DEFAULT_MIN_INTERVAL = 10 * 60
+
+class BatchScheduler:
+    """
+    Decides how many pull requests to raise against the target repository,
+    and when, from signals we can measure rather than a fixed sleep:
+
+    * how many automatically raised pull requests are still open awaiting
+      review, which may not exceed "max_in_flight";
+    * the load average of this node, which must be under "max_load" (by
+      default, the number of CPUs);
+    * a minimum interval between submissions, so reviewers aren't flooded.
+
+    Batches shrink, down to a single pull request, as the review queue fills.
+
+    Open pull requests are read through the GitHub client's response cache,
+    so polling them costs little while nothing changes.
+    """
+    def __init__(self, merger, repo_name, scheduler_config, clock=time.time, sleep=time.sleep):
+        self.merger = merger
+        self.repo_name = repo_name
+        self.max_in_flight = scheduler_config.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT)
+        self.max_batch_size = scheduler_config.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE)
+        self.max_load = scheduler_config.get('max_load', os.cpu_count() or 1)
+        self.poll_interval = scheduler_config.get('poll_interval', DEFAULT_POLL_INTERVAL)
+        self.min_interval = scheduler_config.get('min_interval', DEFAULT_MIN_INTERVAL)
+        self.clock = clock
+        self.sleep = sleep
+        self.last_submitted = None
+
+    def count_open_auto_prs(self):
+        """ Count pull requests we raised which are still open on the target repository """
+        url = 'https://api.github.com/repos/%s/pulls?state=open&per_page=100' % self.repo_name
+        count = 0
+        for pr in self.merger.github.get_json(url):
+            if pr['user'] and pr['user']['login'] == self.merger.git_username and pr['title'].startswith('[Auto]'):
+                count += 1
+        return count
+
+    def next_batch_size(self):
+        """ Number of pull requests which may be raised right now, possibly zero """
+        if self.last_submitted and self.clock() < self.last_submitted + self.min_interval:
+            return 0
+        if os.getloadavg()[0] > self.max_load:
+            print('Load average above %s, holding off' % self.max_load)
+            return 0
+        in_flight = self.count_open_auto_prs()
+        if in_flight >= self.max_in_flight:
+            print('%d automatic pull requests awaiting review, holding off' % in_flight)
+            return 0
+        # Shrink batches as the review queue fills, so reviewers who are
+        # behind get smaller pull requests to work through
+        free = self.max_in_flight - in_flight
+        return max(1, (self.max_batch_size * free + self.max_in_flight - 1) // self.max_in_flight)
+
+    def wait_for_capacity(self):
+        """ Block until a batch may be raised, then return the maximum size for it """
+        while True:
+            batch_size = self.next_batch_size()
+            if batch_size > 0:
+                return batch_size
+            wait = self.poll_interval
+            if self.last_submitted:
+                remaining_interval = self.last_submitted + self.min_interval - self.clock()
+                if remaining_interval > 0:
+                    wait = min(wait, remaining_interval)
+            self.sleep(wait)
+
+    def submitted(self):
+        """ Record that a batch has just been raised """
+        self.last_submitted = self.clock()
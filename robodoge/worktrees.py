@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import os.path
+import pygit2
+
+from . import *
+
+# Per-process state for pool workers, set up by _init_worker()
+_worker_merger = None
+_worker_conn = None
+
+class WorktreePool:
+    """
+    Pool of linked git worktrees sharing the Dogecoin repository's object
+    store, used to evaluate several pull requests at once. Each worker
+    process takes one worktree for its lifetime, with its own index, HEAD
+    and build tree, so builds never trample each other.
+    """
+    def __init__(self, merger, path, size):
+        self.merger = merger
+        self.path = path
+        self.size = max(1, size)
+        self.names = ['robodoge-worker-%d' % i for i in range(self.size)]
+
+    def create(self):
+        """ Create any worktrees in the pool which don't already exist """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        existing = self.merger.repo.list_worktrees()
+        for name in self.names:
+            if name not in existing:
+                print('Creating worktree %s' % name)
+                # With no reference given, this also creates a branch of the same name for the worktree
+                self.merger.repo.add_worktree(name, os.path.join(self.path, name))
+
+    def imap(self, function, items):
+        """
+        Run "function(conn, merger, item)" for each item across the pool, for
+        example test_pr_merge() over a list of pull request IDs. The function
+        must be defined at module level so it can be sent to the workers.
+        Yields results in the same order as the items, as they become
+        available.
+        """
+        free_paths = multiprocessing.Queue()
+        for name in self.names:
+            free_paths.put(os.path.join(self.path, name))
+        with multiprocessing.Pool(self.size, _init_worker, (self.merger.config, free_paths)) as pool:
+            for result in pool.imap(_call, [(function, item) for item in items]):
+                yield result
+
+def _init_worker(config, free_paths):
+    """ Claim a worktree for this worker process, and open the repository and database for it """
+    global _worker_merger, _worker_conn
+    path = free_paths.get()
+    _worker_merger = Robodoge(config, path)
+    # Each worktree has its own home branch to return to; the main checkout's
+    # safe branch can't be checked out in more than one worktree
+    _worker_merger.safe_branch = _worker_merger.repo.lookup_branch(os.path.basename(path), pygit2.GIT_BRANCH_LOCAL)
+    _worker_conn = _worker_merger.get_connection()
+
+def _call(task):
+    (function, item) = task
+    return function(_worker_conn, _worker_merger, item)
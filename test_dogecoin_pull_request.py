@@ -1,96 +1,19 @@
 #!/usr/bin/python3
 
-from io import BytesIO
-import boto
-from boto.s3.key import Key
 import os
-import json
-import pycurl
 import pygit2
-import subprocess
 import sys
 import time
 import robodoge
+import robodoge.artifacts
+import robodoge.buildcache
+import robodoge.client
 
-def report_success(config, pr, s3_arn):
-    buffer = BytesIO()
-    request = {'operation': 'build_success', 's3_arn': s3_arn}
-    c = pycurl.Curl()
-    c.setopt(c.URL, config['coordinator']['url'] + '/automerge/api/v1.0/pr/' + str(pr['id']))
-    c.setopt(c.POSTFIELDS, json.dumps(request))
-    c.setopt(c.HTTPHEADER, ["Content-Type: application/json; charset=utf-8"])
-    c.setopt(c.USERNAME, config['http_auth']['user'])
-    c.setopt(c.PASSWORD, config['http_auth']['password'])
-    c.setopt(pycurl.CAINFO, '/etc/ssl/certs/428b13e3.0') # FIXME: Why isn't this found?
-    c.setopt(c.WRITEDATA, buffer)
-    c.setopt(c.POST, 1)
-    c.perform()
-    status_code = c.getinfo(c.RESPONSE_CODE)
-    c.close()
-
-    if status_code < 200 or status_code> 299:
-        raise robodoge.Error("Returned status from merger coordinator was %d, expected 200-range status code" % status_code)
-    result = json.loads(buffer.getvalue().decode('UTF-8'))
-    return result
-
-def get_pr(config):
-    # Get PR from remote web service
-    buffer = BytesIO()
-    c = pycurl.Curl()
-    c.setopt(c.URL, config['coordinator']['url'] + '/automerge/api/v1.0/pr/build_ready')
-    c.setopt(c.USERNAME, config['http_auth']['user'])
-    c.setopt(c.PASSWORD, config['http_auth']['password'])
-    c.setopt(pycurl.CAINFO, '/etc/ssl/certs/428b13e3.0') # FIXME: Why isn't this found?
-    c.setopt(c.WRITEDATA, buffer)
-    c.perform()
-    status_code = c.getinfo(c.RESPONSE_CODE)
-    c.close()
-
-    if status_code < 200 or status_code> 299:
-        raise robodoge.Error("Returned status from merger coordinator was %d, expected 200-range status code" % status_code)
-    prs = json.loads(buffer.getvalue().decode('UTF-8'))
-    if not 'prs' in prs:
-        return None
-
-    for pr in prs['prs']:
-        if not pr['number']:
-            continue
-
-        buffer = BytesIO()
-        request = {'operation': 'claim_build'}
-        c = pycurl.Curl()
-        c.setopt(c.URL, config['coordinator']['url'] + '/automerge/api/v1.0/pr/' + str(pr['id']))
-        c.setopt(c.POSTFIELDS, json.dumps(request))
-        c.setopt(c.HTTPHEADER, ["Content-Type: application/json; charset=utf-8"])
-        c.setopt(c.USERNAME, config['http_auth']['user'])
-        c.setopt(c.PASSWORD, config['http_auth']['password'])
-        c.setopt(pycurl.CAINFO, '/etc/ssl/certs/428b13e3.0') # FIXME: Why isn't this found?
-        c.setopt(c.WRITEDATA, buffer)
-        c.setopt(c.POST, 1)
-        c.perform()
-        status_code = c.getinfo(c.RESPONSE_CODE)
-        c.close()
-
-        if status_code < 200 or status_code> 299:
-           raise robodoge.Error("Returned status from merger coordinator was %d, expected 200-range status code" % status_code)
-        result = json.loads(buffer.getvalue().decode('UTF-8'))
-        if 'result' in result and result['result'] == 'ok':
-            return pr
-
-    return None
-
-# Script to test a single pull request from the Dogecoin repo
+# Seconds to ask the coordinator to hold a claim open while no builds are available
+DEFAULT_CLAIM_WAIT = 60
 
-config = robodoge.load_configuration('config.yml')
-try:
-    merger = robodoge.Robodoge(config)
-except robodoge.ConfigurationError as err:
-    print(err.msg)
-    sys.exit(1)
-
-# Get PR from remote web service
-pr = get_pr(config)
-while pr:
+def build_pr(merger, uploader, pr):
+    """ Build a claimed PR and upload the results, returning the S3 ARN of the daemon """
     pr_number = pr['number']
     print('Build PR #' + str(pr_number))
 
@@ -99,45 +22,95 @@ while pr:
     repo = merger.repo
     merger.repo.checkout(merger.safe_branch)
 
-    # Pull from remote
-    merger.repo.remotes['upstream'].fetch()
+    # Fetch just the PR and the branch it targets
+    merger.fetch_pr(pr_number, pr['base_ref'])
 
     # Check out PR branch
     pr_branch_name = 'upstream/pr/' + str(pr_number)
     pr_branch = merger.repo.lookup_branch(pr_branch_name, pygit2.GIT_BRANCH_REMOTE)
     if not pr_branch:
-        print('Could not find PR branch ' + pr_branch_name)
-        sys.exit(1)
+        raise robodoge.Error('Could not find PR branch ' + pr_branch_name)
+    # Detach HEAD at the PR, so both the build and the build cache key see its tree
+    pr_commit = pr_branch.peel(pygit2.Commit)
+    merger.repo.checkout_tree(pr_commit.tree, strategy=pygit2.GIT_CHECKOUT_FORCE)
+    merger.repo.set_head(pr_commit.id)
 
     # TODO: Rebase on 1.9-dev
 
     # Compile and run unit tests - raises an error if this fails
-    # TODO: Catch error and report gently
-    robodoge.compile_dogecoin(merger.config['dogecoin_repo']['path'])
-
-    # Upload to S3
-    s3 = boto.connect_s3()
-    bucket = s3.get_bucket(config['s3']['bucket'])
-    daemon_key = Key(bucket)
-    daemon_key.key = config['s3']['client_path'] + '/' + str(pr_number) + '/dogecoind'
-    print('Uploading ' + config['dogecoin_repo']['path'] + '/src/dogecoind' + " to " + config['s3']['client_path'] + '/' + str(pr_number) + '/dogecoind')
-    daemon_key.set_contents_from_filename(config['dogecoin_repo']['path'] + '/src/dogecoind')
-    daemon_key.close()
-
-    client_key = Key(bucket)
-    client_key.key = config['s3']['client_path'] + '/' + str(pr_number) + '/dogecoin-cli'
-    client_key.set_contents_from_filename(config['dogecoin_repo']['path'] + '/src/dogecoin-cli')
-    client_key.close()
-
-    tx_key = Key(bucket)
-    tx_key.key = config['s3']['client_path'] + '/' + str(pr_number) + '/dogecoin-tx'
-    tx_key.set_contents_from_filename(config['dogecoin_repo']['path'] + '/src/dogecoin-tx')
-    tx_key.close()
-
-    # Tell the remote web service about the success
-    s3_arn = 'arn:aws:s3:::' + config['s3']['bucket'] + '/' + config['s3']['client_path'] + '/' + str(pr_number) + '/dogecoind'
-    report_success(config, pr, s3_arn)
-
-    print('Build succeeded')
-
-    pr = get_pr(config)
+    build_result = merger.build_checkout()
+    if build_result:
+        # Upload the build cache's copies, which match the tree even if the build was skipped
+        artifacts = build_result.artifacts
+    else:
+        artifacts = dict((name, os.path.join(path, name)) for name in robodoge.buildcache.DEFAULT_ARTIFACTS)
+
+    if 'src/dogecoind' not in artifacts:
+        raise robodoge.artifacts.ArtifactError('Build of PR #%d produced no src/dogecoind artifact' % pr_number)
+
+    # Upload everything at once, skipping binaries identical to ones already uploaded
+    urls = uploader.upload(artifacts, str(pr_number))
+    return urls['src/dogecoind']
+
+# Script to build pull requests from the Dogecoin repo. Runs as a persistent
+# worker, long-polling the coordinator for work; pass --once to exit once no
+# builds are available.
+
+config = robodoge.load_configuration('config.yml')
+try:
+    merger = robodoge.Robodoge(config)
+except robodoge.ConfigurationError as err:
+    print(err.msg)
+    sys.exit(1)
+# Created once, so all builds share one storage connection and one coordinator connection
+uploader = robodoge.artifacts.build_uploader(config)
+coordinator = robodoge.client.build_coordinator_client(config)
+
+once = '--once' in sys.argv
+wait = 0 if once else config['coordinator'].get('claim_wait', DEFAULT_CLAIM_WAIT)
+
+while True:
+    try:
+        # Get PR from remote web service
+        pr = coordinator.claim_next(wait)
+    except robodoge.client.CoordinatorError as err:
+        if once:
+            raise
+        # Coordinator unavailable; back off rather than spinning
+        print('Could not claim a build: %s' % err)
+        time.sleep(wait or DEFAULT_CLAIM_WAIT)
+        continue
+    if not pr:
+        if once:
+            break
+        continue
+
+    try:
+        if pr['lease_duration']:
+            # Keep the claim alive through long compiles
+            with robodoge.client.LeaseHeartbeat(coordinator, pr['id'], pr['lease_duration']):
+                s3_arn = build_pr(merger, uploader, pr)
+        else:
+            s3_arn = build_pr(merger, uploader, pr)
+    except (robodoge.Error, pygit2.GitError) as err:
+        print('Build of PR #%d failed: %s' % (pr['number'], err))
+        s3_arn = None
+
+    # Tell the remote web service how the build went
+    try:
+        if s3_arn:
+            result = coordinator.report_build_success(pr['id'], s3_arn)
+        else:
+            result = coordinator.report_build_failed(pr['id'])
+    except robodoge.client.CoordinatorError as err:
+        if once:
+            raise
+        # The lease will expire and the PR return to the queue
+        print('Could not report build of PR #%d: %s' % (pr['number'], err))
+        continue
+    if result.get('result') != 'ok':
+        print('Coordinator rejected the result for PR #%d: %s' % (pr['number'], result.get('result')))
+    elif s3_arn:
+        print('Build succeeded')
+    for (name, stats) in sorted(coordinator.stats.items()):
+        print('  coordinator %s: %s' % (name, stats))